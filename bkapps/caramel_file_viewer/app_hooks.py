@@ -0,0 +1,10 @@
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..', 'code'))
+from caramelio import loadDataset
+
+
+def on_server_loaded(server_context):
+    # Parse the default dataset once per server process; every session starts
+    # from these shared, read-only arrays
+    server_context.caramel_dataset = loadDataset(os.path.dirname(os.path.abspath(__file__)))
@@ -5,21 +5,31 @@ from bokeh.io import curdoc
 from bokeh.plotting import figure
 from bokeh.layouts import row, column
 from bokeh.models import CrosshairTool, WheelZoomTool, ResetTool, PanTool, BoxSelectTool, HoverTool, BoxZoomTool
-from bokeh.models import ColumnDataSource, CustomJS, Div, DatePicker, FileInput
+from bokeh.models import ColumnDataSource, CustomJS, Div, DatePicker, FileInput, Slider
 
-from base64 import b64decode
+from bokeh.document import without_document_lock
+from tornado.ioloop import IOLoop
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
-# First choose some default data to show
-spectra = np.loadtxt('caramel_file_viewer/spectra.txt')
-cont = np.loadtxt('caramel_file_viewer/continuum.txt')
-times = np.loadtxt('caramel_file_viewer/times.txt')
-cont[:,0] /= 86400.
-times[:,0] /= 86400.
-cont[:,0] -= 2450000
-times[:,0] -= 2450000
-wave = spectra[0]
-spec = spectra[1::2]
-err = spectra[2::2]
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..', 'code'))
+from bkmetrics import instrument, timed
+from caramelio import loadDataset, parseUpload, sortEpochs
+from blrmodel import PARAMETERS, StagedModel, LightCurvePredictor, scaleToData
+
+# First choose some default data to show. The server parses it once (see
+# app_hooks.py) and the sessions share its read-only arrays.
+server_context = getattr(curdoc().session_context, 'server_context', None)
+dataset = getattr(server_context, 'caramel_dataset', None)
+if dataset is None:
+    dataset = loadDataset(os.path.dirname(os.path.abspath(__file__)))
+wave = dataset['wave']
+spec = dataset['spec']
+err = dataset['err']
+cont = dataset['cont']
+times = dataset['times']
 
 
 df_cont = pd.DataFrame(cont, columns=['time','flux','flux_err'])
@@ -32,17 +42,40 @@ df_int = pd.DataFrame(
     columns=['time','flux','flux_err']
 )
 
-# TODO: Temporary fix -- currently appending np.zeros() spectra to the end of the
-#       spectrum DataFrame. This is to account for the new uploaded files to have
-#       more spectra than the default. Currently maxed at 200.
-npad = 200
-pad = np.zeros((npad-len(spec),len(spec[0])))
-df_spec = pd.DataFrame(np.vstack([wave,spec,pad]).T, columns=['wave'] + [str(i) for i in range(npad)])  #, columns=['wave']+times[:,0].tolist())
-source_spec = ColumnDataSource(df_spec)
+# One (ragged) line per spectrum, so any number of epochs can be shown
+source_spec = ColumnDataSource(data={'xs': [wave]*len(spec), 'ys': list(spec)})
+# The spectrum highlighted by the hover tool
+source_highlight = ColumnDataSource(data={'x': [], 'y': []})
 df_cont = pd.DataFrame(cont, columns=['time','flux','flux_err'])
 source_cont = ColumnDataSource(df_cont)
 source_int = ColumnDataSource(df_int)
 
+# The BLR model whose predicted emission line light curve, the continuum
+# convolved with the model's lag distribution, is overlaid on the line panel
+Nmodel = 20000
+randoms = {
+    'rand1': np.linspace(0,1,Nmodel),
+    'rand2': np.random.uniform(-1,1,Nmodel),
+    'rand3': np.random.uniform(-1,1,Nmodel),
+    'phi': np.random.uniform(0,2.*np.pi,Nmodel),
+}
+sliders = {
+    name: Slider(start=low, end=high, value=value, step=step, title=title)
+    for name, title, low, high, step, value in PARAMETERS
+}
+blr = StagedModel(randoms)
+blr.update({name: sliders[name].value for name in sliders.keys()})
+predictor = LightCurvePredictor(df_cont['time'].values, df_cont['flux'].values)
+
+def predictLine():
+    arrays = blr.arrays()
+    t, line = predictor.predict(arrays['lags'], arrays['size'])
+    data = source_int.data
+    line = scaleToData(t, line, np.asarray(data['time']), np.asarray(data['flux']), np.asarray(data['flux_err']))
+    return {'time': t, 'flux': line}
+
+source_pred = ColumnDataSource(data=predictLine())
+
 # Create the figure panels
 # Continuum
 p1 = figure(
@@ -62,6 +95,7 @@ p2 = figure(
     tools=""
 )
 p2.scatter('time','flux', color='orange', source=source_int, name='integrated')
+p2.line('time','flux', color='black', source=source_pred, name='prediction')
 
 # Emission line spectra
 p3 = figure(
@@ -70,44 +104,45 @@ p3 = figure(
     y_axis_label='Flux',
 )
 
-for i in range(npad):
-    p3.line('wave', str(i), source=source_spec, color='grey', width=0.5, alpha=0.5)
-# Create "highlighted" versions of each spectrum, but set visible=False
-line_highlighted = {}
-for i in range(npad):
-    line_highlighted[i] = p3.line('wave', str(i), source=source_spec, color='orange', width=2, visible=False)
+p3.multi_line('xs', 'ys', source=source_spec, color='grey', line_width=0.5, alpha=0.5)
+p3.line('x', 'y', source=source_highlight, color='orange', line_width=2)
 
 # CustomJS callback for the hover tool
-callback_hover_js = CustomJS(args=dict(line=line_highlighted, source=source_int), code="""
-    const data = source.data;
-    const times = data.time;
-    
-    // Reset all previously highlighted lines
-    for (var i=0; i<times.length; i++) {
-        line[i].properties.visible.spec.value = false;
-        line[i].change.emit();
-    }
-    
+callback_hover_js = CustomJS(args=dict(spectra=source_spec, highlight=source_highlight, source=source_int), code="""
+    const times = source.data.time;
+    const n = times.length;
+    if (n == 0)
+        return;
+
     // Get the x position of the cursor
-    const geometry = cb_data.geometry;
-    const xval = geometry['x'];
-
-    // Find the closest of the plotted dates
-    var closest;
-    var distance = 1e9;  // Require maximum 1e9 day distance
-    for (var i=0; i<times.length; i++) {
-        if (Math.abs(xval - times[i]) < distance) {
-            closest = i;
-            distance = Math.abs(xval - times[i]);
-        }
+    const xval = cb_data.geometry['x'];
+
+    // Find the closest of the plotted dates, which are sorted, by bisection
+    let lo = 0;
+    let hi = n;
+    while (lo < hi) {
+        const mid = (lo + hi) >> 1;
+        if (times[mid] < xval)
+            lo = mid + 1;
+        else
+            hi = mid;
     }
-    
+    let closest = lo;
+    if (lo == n || (lo > 0 && xval - times[lo-1] <= times[lo] - xval))
+        closest = lo - 1;
+    const distance = Math.abs(xval - times[closest]);
+
     // Dynamically set the maximum distance to highlight
     // This should account for, various lengths of observing campaigns.
-    const maxdist = (times[times.length-1] - times[0])/50;
-    if (distance < maxdist) {
-        line[closest].properties.visible.spec.value = true;
-        line[closest].change.emit();
+    const maxdist = (times[n-1] - times[0])/50;
+    const ys = distance < maxdist ? spectra.data.ys[closest] : null;
+
+    // Only update the highlighted line when it changes
+    if (ys === null) {
+        if (highlight.data.x.length > 0)
+            highlight.data = {x: [], y: []};
+    } else if (highlight.data.y !== ys) {
+        highlight.data = {x: spectra.data.xs[closest], y: ys};
     }
     """)
 
@@ -138,7 +173,9 @@ p2.toolbar_location = None
 
 # Array to keep track of which files have been loaded
 new_files = np.array([0,0,0])
+@timed("caramel_file_viewer.update_data")
 def update_data():
+    global times, spec, err, predictor
     new_files = np.array([0,0,0])
     print("New files loaded")
     
@@ -146,66 +183,93 @@ def update_data():
     times[:,0] /= 86400.
     cont[:,0] -= 2450000
     times[:,0] -= 2450000
+    times, spec, err = sortEpochs(times, spec, err)
     
     new_data_int = {'time': times[:,0], 'flux': np.sum(spec,axis=1), 'flux_err': np.sqrt(np.sum(err**2,axis=1))}
     new_data_cont = {'time': cont[:,0], 'flux': cont[:,1], 'flux_err': cont[:,2]}
-    new_data_spec = {'wave': wave}
-    
-    for i in range(len(spec)):
-        new_data_spec[str(i)] = spec[i]
-    for i in range(len(spec),npad):
-        new_data_spec[str(i)] = np.zeros(len(spec[0]))
+    new_data_spec = {'xs': [wave]*len(spec), 'ys': list(spec)}
 
     source_int.data = new_data_int
     source_cont.data = new_data_cont
     source_spec.data = new_data_spec
+    source_highlight.data = {'x': [], 'y': []}
 
-def upload_spectra(attr, old, new):
-    global wave, spec, err
-    decoded = b64decode(new).decode('ascii')
-    spectra = np.array([[float(item) for item in line.split(' ')] for line in decoded.splitlines()[1:]])
-    wave = spectra[0]
-    spec = spectra[1::2]
-    err = spectra[2::2]
-    
-    new_files[0] = 1
-    if np.prod(new_files) == 1:
-        update_data()
+    predictor = LightCurvePredictor(cont[:,0], cont[:,1])
+    source_pred.data = predictLine()
 
-def upload_continuum(attr, old, new):
-    global cont
-    decoded = b64decode(new).decode('ascii')
-    cont = np.array([[float(item) for item in line.split(' ')] for line in decoded.splitlines()])
+@timed("caramel_file_viewer.callback_model")
+def callback_model(attr, old, new):
+    # Only the model stages downstream of the moved slider are recomputed
+    blr.update({name: sliders[name].value for name in sliders.keys()})
+    source_pred.data = predictLine()
+
+# Uploads are decoded and parsed on a worker thread, so the session stays
+# responsive while a large file is read
+doc = curdoc()
+executor = ThreadPoolExecutor(max_workers=1)
+doc.on_session_destroyed(lambda session_context: executor.shutdown(wait=False))
+upload_kinds = ["spectra", "continuum", "times"]
+
+# Scheduled as without_document_lock(partial(ingest, ...)): a partial loses the
+# nolock flag of a decorated function, and the parse would then hold the lock
+async def ingest(kind, value):
+    # The spectra text files start with a header line
+    skiprows = 1 if kind == "spectra" else 0
+    try:
+        array = await IOLoop.current().run_in_executor(executor, parseUpload, value, kind, skiprows)
+    except ValueError as e:
+        print("Could not read the {} file: {}".format(kind, e))
+        return
+    doc.add_next_tick_callback(partial(apply_upload, kind, array))
+
+@timed("caramel_file_viewer.apply_upload")
+def apply_upload(kind, array):
+    global wave, spec, err, cont, times
+    if kind == "spectra":
+        wave = array[0]
+        spec = array[1::2]
+        err = array[2::2]
+    elif kind == "continuum":
+        cont = array
+    else:
+        times = array
 
-    new_files[1] = 1
+    new_files[upload_kinds.index(kind)] = 1
     if np.prod(new_files) == 1:
         update_data()
 
+@timed("caramel_file_viewer.upload_spectra")
+def upload_spectra(attr, old, new):
+    doc.add_next_tick_callback(without_document_lock(partial(ingest, "spectra", new)))
+
+@timed("caramel_file_viewer.upload_continuum")
+def upload_continuum(attr, old, new):
+    doc.add_next_tick_callback(without_document_lock(partial(ingest, "continuum", new)))
+
+@timed("caramel_file_viewer.upload_times")
 def upload_times(attr, old, new):
-    global times
-    decoded = b64decode(new).decode('ascii')
-    times = np.array([[float(item) for item in line.split(' ')] for line in decoded.splitlines()])
-    
-    new_files[2] = 1
-    if np.prod(new_files) == 1:
-        update_data()
+    doc.add_next_tick_callback(without_document_lock(partial(ingest, "times", new)))
 
 div_spec = Div(text="Spectrum:")
 div_time = Div(text="Times:")
 div_cont = Div(text="Continuum:")
-file_input_spec = FileInput(accept=".txt")
+file_input_spec = FileInput(accept=".txt,.npy,.npz")
 file_input_spec.on_change('value', upload_spectra)
-file_input_time = FileInput(accept=".txt")
+file_input_time = FileInput(accept=".txt,.npy,.npz")
 file_input_time.on_change('value', upload_times)
-file_input_cont = FileInput(accept=".txt")
+file_input_cont = FileInput(accept=".txt,.npy,.npz")
 file_input_cont.on_change('value', upload_continuum)
+for key in sliders.keys():
+    sliders[key].on_change('value', callback_model)
 
 # Set the layout with the sliders and plot
 layout = row(
     column(p1, p2),
     p3,
-    column(div_spec, file_input_spec, div_time, file_input_time, div_cont, file_input_cont)
+    column(div_spec, file_input_spec, div_time, file_input_time, div_cont, file_input_cont),
+    column(Div(text="BLR model:"), *[sliders[key] for key in sliders.keys()])
 )
 
 # add the layout to curdoc
-curdoc().add_root(layout)
\ No newline at end of file
+doc.add_root(layout)
+instrument(doc)
\ No newline at end of file
@@ -2,119 +2,25 @@ from bokeh.io import curdoc
 import numpy as np
 from bokeh.layouts import column, row
 from bokeh.plotting import figure
-from bokeh.models import ColumnDataSource
+from bokeh.models import ColumnDataSource, LinearColorMapper
 from bokeh.models.widgets import Slider, Button
+from bokeh.document import without_document_lock
+from tornado.ioloop import IOLoop
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
-def rotate(x, y, C, S):
-    return C*x + S*y, -S*x + C*y
-
-def buildModel(randoms, params):
-    rand1, rand2, rand3, phi = randoms['rand1'], randoms['rand2'], randoms['rand3'], randoms['phi']
-    beta, mu, F = params['beta'], params['mu'], params['F']
-    thetao, thetai, gamma = params['thetao'], params['thetai'], params['gamma']
-    kappa, Mbh = params['kappa'], 10**params['logMbh']
-    
-    alpha = beta**-2.0
-    rmin = mu * F
-    theta = (mu - rmin) / alpha
-    
-    # Compute the gamma function
-    rmax = 500.
-    xvals = np.linspace(0,rmax,500)
-    
-    # Compute the gamma distribution from 0 to rmax, then normalize
-    gamma_distr = (xvals - rmin)**(alpha - 1.) * np.exp(-(xvals - rmin) / theta)
-    gamma_distr = np.where(~np.isnan(gamma_distr), gamma_distr, 0.0)
-    gamma_distr = np.where(gamma_distr > 0.0, gamma_distr, 0.0)
-    gamma_distr = gamma_distr / np.sum(gamma_distr)
-    
-    # Compute the cdf
-    cdf = [np.sum(gamma_distr[:i+1]) for i in range(len(gamma_distr))]
-    
-    # Take sorted distribution of values 0-1 to draw from cdf
-    r = np.array([xvals[np.argmin(abs(cdf - rand))] for rand in rand1])
-
-    # Determine the per-particle opening angles
-    part1 = np.cos(thetao * np.pi / 180.)
-    part2 = 1. - np.cos(thetao * np.pi / 180.)
-    part3 = np.exp(np.log(rand2) * gamma)
-    angle = np.arccos(part1 + part2 * part3)
-    
-    # Pre-calculate some sines and cosines
-    sin1 = np.sin(angle)
-    cos1 = np.cos(angle)
-    sin2 = np.sin(rand3 * np.pi)
-    cos2 = np.cos(rand3 * np.pi)
-    sin3 = np.sin(0.5 * np.pi - thetai * np.pi / 180.)
-    cos3 = np.cos(0.5 * np.pi - thetai * np.pi / 180.)
-    
-    sinPhi = np.sin(phi)
-    cosPhi = np.cos(phi)
-
-    ################################################
-    # Set the positions
-    # Turn radial distribution into a disk
-    x = r * cosPhi
-    y = r * sinPhi
-    z = np.zeros(len(r))
-    
-    # Puff up by opening angle
-    x, z = rotate(x, z, cos1, sin1)
-    
-    # Restore axi-symmetry
-    x, y = rotate(x, y, cos2, sin2)
-    
-    # Rotate by inclination angle (+pi/2)
-    x, z = rotate(x, z, cos3, sin3)
-
-    ################################################
-    # Compute the velocities
-    G = 6.673e-11
-
-    # Assume purely circular for now
-    vr = np.zeros(len(r))
-    vphi = np.sqrt(G * Mbh / r)  # * sin(theta)*exp(radial_sd_orbiting*n2[i][j]);
-    
-    # Convert to cartesian coordinates
-    vx = vr * cosPhi - vphi * sinPhi    
-    vy = vr * sinPhi + vphi * cosPhi
-    vz = np.zeros(len(r))
-    
-    # Puff up by opening angle
-    vx, vz = rotate(vx, vz, cos1, sin1)
-    # Restore axi-symmetry
-    vx, vy = rotate(vx, vy, cos2, sin2)
-    # Rotate by inclination angle (+pi/2)
-    vx, vz = rotate(vx, vz, cos3, sin3)
-    # Convert vx to km/s
-    vx *= 299792458. / 1000.
-    
-    ################################################
-    # Compute the weights
-    size = 0.5 + kappa * x/r
-    size = np.where(np.isnan(size),0.0,size)
-    size *= 1.0 * len(size) / np.sum(size)
-    
-    ################################################
-    # Compute the lags
-    lags = r - x
-    
-    return x, y, z, vx, lags, size, xvals, gamma_distr
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..', 'code'))
+from bkmetrics import instrument, timed
+from blrmodel import PARAMETERS, CachedModel, TransferFunction
 
 
 # Set the data
-start = {
-    'thetai': 40.,
-    'thetao': 30.,
-    'kappa': -0.4,
-    'beta': 0.85,
-    'mu': 19.5,
-    'F': 0.29,
-    'logMbh': 7.9,
-    'gamma': 3.0,
-}
+start = {name: value for name, title, low, high, step, value in PARAMETERS}
 
-Ndata = 1000
+# The number of particles, e.g. bokeh serve slider_app --args 1000000
+Ndata = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
 rand1 = np.linspace(0,1,Ndata)
 phi = np.random.uniform(0,2.*np.pi,Ndata)
 rand2 = np.random.uniform(-1,1,Ndata)
@@ -122,14 +28,36 @@ rand3 = np.random.uniform(-1,1,Ndata)
 
 randoms = {'rand1':rand1, 'rand2':rand2, 'rand3':rand3, 'phi':phi}
     
-# Set the starting data
-x, y, z, vx, lags, size, gamma_x, gamma_y = buildModel(randoms, start)
-r = np.sqrt(x**2 + y**2 + z**2)
+# Create the slider widgets
+sliders = {
+    name: Slider(start=low, end=high, value=start[name], step=step, title=title)
+    for name, title, low, high, step, value in PARAMETERS
+}
+reset_button = Button(label='Reset')
+
+# Set the starting data. The model keeps its intermediate arrays, so a
+# slider change only recomputes the stages that depend on it, and caches the
+# results of the values on the slider steps.
+model = CachedModel(randoms, {key: (sliders[key].start, sliders[key].end, sliders[key].step) for key in sliders.keys()})
+changed, arrays = model.get(start)
+
+# Above TF_IMAGE_LIMIT particles the transfer function is shown as a weighted
+# 2D histogram computed on the server instead of a scatter of every particle
+TF_IMAGE_LIMIT = 20000
+tf_image = Ndata > TF_IMAGE_LIMIT
+model_columns = ['x','y','z','size','r'] if tf_image else ['x','y','z','vx','lags','size','r']
+
 source_model = ColumnDataSource(data=dict(
-    x=x, y=y, z=z, size=size, lags=lags, vx=vx,
-    r=r, rand1=rand1,rand2=rand2,rand3=rand3,phi=phi
+    {key: arrays[key] for key in model_columns}, rand1=rand1,rand2=rand2,rand3=rand3,phi=phi
 ))
-source_gamma = ColumnDataSource(data=dict(gamma_x=gamma_x,gamma_y=gamma_y))
+source_gamma = ColumnDataSource(data=dict(gamma_x=arrays['gamma_x'],gamma_y=arrays['gamma_y']))
+if tf_image:
+    transfer = TransferFunction(vx_range=(-15000., 15000.), lag_range=(0., 100.), bins=(150, 100))
+    image, vprofile, lagprofile = transfer.update(changed, arrays)
+    vx_centers, lag_centers = transfer.centers()
+    source_tf = ColumnDataSource(data=dict(image=[image]))
+    source_vprofile = ColumnDataSource(data=dict(vx=vx_centers, profile=vprofile))
+    source_lagprofile = ColumnDataSource(data=dict(lags=lag_centers, profile=lagprofile))
 
 # Create the figure panels
 p_edge = figure(x_range=(-50, 50), y_range=(-50, 50), plot_width=300, plot_height=300, toolbar_location=None)
@@ -148,51 +76,110 @@ p_gamma.yaxis.axis_label = "P(r)"
 
 p_edge.scatter('x', 'z', size='size', source=source_model)
 p_face.scatter('y', 'z', size='size', source=source_model)
-p_tf.scatter('vx', 'lags', size='size', source=source_model)
 p_gamma.scatter('gamma_x', 'gamma_y', source=source_gamma)
-    
-# Create the slider widgets
-sliders = {
-    "thetai": Slider(start=0.0, end=90., value=start['thetai'], step=1, title="Inclination angle (deg)"),
-    "thetao": Slider(start=0.0, end=90., value=start['thetao'], step=1, title="Opening angle (deg)"),
-    "gamma": Slider(start=1.0, end=5.0, value=start['gamma'], step=0.1, title="Gamma"),
-    "kappa": Slider(start=-0.5, end=0.5, value=start['kappa'], step=0.05, title="Kappa"),
-    "beta": Slider(start=0.1, end=2.0, value=start['beta'], step=0.05, title="Beta"),
-    "mu": Slider(start=7.5, end=72.5, value=start['mu'], step=1, title="Mu (light days)"),
-    "F": Slider(start=0.125, end=0.825, value=start['F'], step=0.01, title="F"),
-    "logMbh": Slider(start=6.5, end=8.5, value=start['logMbh'], step=0.1, title="log10(Mbh/Msun)"),
-}
-reset_button = Button(label='Reset')
-
-# Set the code to update the data when the sliders are change
+if tf_image:
+    p_tf.image(
+        image='image', x=-15000, y=0, dw=30000, dh=100, source=source_tf,
+        color_mapper=LinearColorMapper(palette="Viridis256", low=0))
+    # The velocity profile and lag distribution, projected from the image
+    p_vprofile = figure(x_range=p_tf.x_range, plot_width=300, plot_height=150, toolbar_location=None)
+    p_lagprofile = figure(y_range=p_tf.y_range, plot_width=150, plot_height=300, toolbar_location=None)
+    p_vprofile.xaxis.axis_label = "Velocity (km/s)"
+    p_lagprofile.yaxis.axis_label = "Lag (light days)"
+    p_vprofile.step('vx', 'profile', mode="center", source=source_vprofile)
+    p_lagprofile.step('profile', 'lags', mode="center", source=source_lagprofile)
+else:
+    p_tf.scatter('vx', 'lags', size='size', source=source_model)
+    
+
+# Set the code to update the data when the sliders are change. The model is
+# evaluated on a worker thread, latest request wins: parameter sets that
+# arrive while it is busy replace each other, so only the newest is computed.
+doc = curdoc()
+executor = ThreadPoolExecutor(max_workers=1)
+doc.on_session_destroyed(lambda session_context: executor.shutdown(wait=False))
+pending = {}
+evaluating = [False]
+
+# Large models are only recomputed when a slider is released
+PREVIEW_LIMIT = 100000
+slider_event = "value" if Ndata <= PREVIEW_LIMIT else "value_throttled"
+
+# The parameters of the last evaluated model
+shown = [dict(start)]
+
+@timed("slider_app.evaluate")
+def evaluateModel(params):
+    changed, arrays = model.get(params, shown[0])
+    shown[0] = params
+    tf = None
+    if tf_image and len(changed & {'vx','lags','size'}) > 0:
+        # Only re-bins the particles if vx or lags changed, otherwise (e.g.
+        # for kappa) the image is re-weighted from the cached bins
+        tf = transfer.update(changed, arrays)
+    return changed, arrays, tf
+
+@timed("slider_app.apply")
+def applyModel(changed, arrays, tf):
+    # Push only the columns that changed, e.g. only vx for a mass change
+    new_model_data = {key: arrays[key] for key in model_columns if key in changed}
+    new_gamma_data = {key: arrays[key] for key in ['gamma_x','gamma_y'] if key in changed}
+    if len(new_model_data) > 0:
+        source_model.data.update(new_model_data)
+    if len(new_gamma_data) > 0:
+        source_gamma.data.update(new_gamma_data)
+    if tf is not None:
+        image, vprofile, lagprofile = tf
+        source_tf.data.update(image=[image])
+        source_vprofile.data.update(profile=vprofile)
+        source_lagprofile.data.update(profile=lagprofile)
+
+@without_document_lock
+async def evaluateLatest():
+    # Reset the flag even if a model fails, or later slider moves are ignored
+    try:
+        while "params" in pending:
+            params = pending.pop("params")
+            changed, arrays, tf = await IOLoop.current().run_in_executor(executor, evaluateModel, params)
+            doc.add_next_tick_callback(partial(applyModel, changed, arrays, tf))
+    finally:
+        evaluating[0] = False
+
+    # While idle, compute the models one slider step away from the shown one
+    for params in model.neighbours(shown[0]):
+        if evaluating[0]:
+            break
+        await IOLoop.current().run_in_executor(executor, model.prefetch, params)
+
+def requestModel(params):
+    pending["params"] = params
+    if not evaluating[0]:
+        evaluating[0] = True
+        doc.add_next_tick_callback(evaluateLatest)
+
+@timed("slider_app.callback_sliders")
 def callback_sliders(attr, old, new):
     params = {key: sliders[key].value for key in sliders.keys()}
-    x, y, z, vx, lags, size, gamma_x, gamma_y = buildModel(randoms, params)
-    new_model_data = dict(x=x,y=y,z=z,vx=vx,lags=lags,size=size)
-    new_gamma_data = dict(gamma_x=gamma_x,gamma_y=gamma_y)
-    source_model.data = new_model_data
-    source_gamma.data = new_gamma_data
+    requestModel(params)
 
+@timed("slider_app.callback_reset")
 def callback_reset():
     for key in sliders.keys():
         sliders[key].value = start[key]
-    x, y, z, vx, lags, size, gamma_x, gamma_y = buildModel(randoms, start)
-    new_model_data = dict(x=x,y=y,z=z,vx=vx,lags=lags,size=size)
-    new_gamma_data = dict(gamma_x=gamma_x,gamma_y=gamma_y)
-    source_model.data = new_model_data
-    source_gamma.data = new_gamma_data
+    requestModel(dict(start))
 
 for key in sliders.keys():
-    sliders[key].on_change("value", callback_sliders)
+    sliders[key].on_change(slider_event, callback_sliders)
 reset_button.on_click(callback_reset)
 # Set the layout with the sliders and plot
 layout = row(
     column(*[sliders[key] for key in sliders.keys()], reset_button),
     column(
         row(p_edge,p_face),
-        row(p_gamma, p_tf)
+        row(p_gamma, column(p_tf, p_vprofile), p_lagprofile) if tf_image else row(p_gamma, p_tf)
     )
 )
 
 # add the layout to curdoc
-curdoc().add_root(layout)
\ No newline at end of file
+doc.add_root(layout)
+instrument(doc)
\ No newline at end of file
@@ -0,0 +1,336 @@
+"""
+Headless benchmarks of BKCorner. Each plot is built into a bare Document, so
+no browser or server is needed, and the results are written as JSON lines
+that can be compared between runs:
+
+    python bkbench.py --rows 1e3 1e5 1e7 --params 2 10 30 --output bench.jsonl
+
+The loadtest command measures the selection throughput of a plot served
+from several worker processes, for each worker count:
+
+    python bkbench.py loadtest --workers 1 2 4 --clients 16 --output load.jsonl
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import signal
+import subprocess
+import sys
+import time
+import tracemalloc
+import urllib.request
+
+import numpy as np
+import pandas as pd
+
+import bokeh
+from bokeh.document import Document
+
+from bkcorner import BKCorner, documentPayloadBytes
+
+
+def makeChain(rows, params, seed=0):
+    """
+    Returns a DataFrame of correlated Gaussian samples, with columns p0, p1, ...
+    """
+    rng = np.random.default_rng(seed)
+    values = rng.standard_normal((rows, params))
+    values[:,1:] += 0.5*values[:,:-1]
+    return pd.DataFrame(values, columns=["p{}".format(i) for i in range(params)])
+
+
+def gitCommit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def buildDoc(corner):
+    doc = Document()
+    start = time.perf_counter()
+    corner.modify_doc(doc)
+    return doc, time.perf_counter() - start
+
+
+def timeSelections(corner, doc, rows, fractions, repeats, seed=0):
+    """
+    Times the selection callback for random index sets of each size.
+
+    Returns a list of dicts with the median, 95th percentile and max latency.
+    """
+    rng = np.random.default_rng(seed)
+    results = []
+    for fraction in fractions:
+        size = max(1, int(fraction*rows))
+        times = []
+        for i in range(repeats):
+            indices = np.sort(rng.choice(rows, size=size, replace=False))
+            start = time.perf_counter()
+            corner.select(indices, doc)
+            times.append(time.perf_counter() - start)
+        results.append({
+            "fraction": fraction,
+            "selected": size,
+            "median_s": float(np.median(times)),
+            "p95_s": float(np.percentile(times, 95)),
+            "max_s": float(np.max(times)),
+        })
+    corner.select([], doc)
+    return results
+
+
+def benchmark(rows, params, render="scatter", fractions=(0.001, 0.01, 0.1, 0.5), repeats=5, memory=True, **kwargs):
+    """
+    Benchmarks one corner plot.
+
+    rows (int): The number of samples
+    params (int): The number of parameters
+    render (str): The BKCorner render mode
+    fractions (list): The sizes of the random selections, as fractions of rows
+    repeats (int): The number of selections timed per size
+    memory (bool): Whether to measure the peak memory of a build (with tracemalloc,
+        in a separate build as tracing slows it down)
+    kwargs: Other BKCorner options
+
+    Returns a dict of the results.
+    """
+    df = makeChain(rows, params)
+    corner = BKCorner(df, output=None, render=render, **kwargs)
+    BKCorner.cache.clear()
+
+    # A cold build computes the derived arrays, a warm one (a second session)
+    # takes them from the cache
+    doc, build_s = buildDoc(corner)
+    warm_doc, warm_build_s = buildDoc(corner)
+    payload_bytes = documentPayloadBytes(doc)
+    selections = timeSelections(corner, doc, rows, fractions, repeats)
+
+    peak_bytes = None
+    if memory:
+        BKCorner.cache.clear()
+        tracemalloc.start()
+        buildDoc(corner)
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    BKCorner.cache.clear()
+
+    return {
+        "rows": rows,
+        "params": params,
+        "render": render,
+        "options": kwargs,
+        "build_s": build_s,
+        "warm_build_s": warm_build_s,
+        "payload_bytes": payload_bytes,
+        "peak_bytes": peak_bytes,
+        "select": selections,
+    }
+
+
+def runContext():
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": gitCommit(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "bokeh": bokeh.__version__,
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def lassoClient(url, duration, seed, queue):
+    """
+    A load test client: opens a session and sends random lasso selections to
+    the scatter panels for duration seconds, waiting for each to be handled.
+    Puts the session open time and the selection latencies on queue.
+    """
+    from bokeh.client import pull_session
+    from bokeh.document.events import MessageSentEvent
+    from bokeh.models import Plot, Scatter
+
+    start = time.perf_counter()
+    session = pull_session(url=url)
+    session_s = time.perf_counter() - start
+    doc = session.document
+    plots = [
+        plot for plot in doc.select({'type': Plot})
+        if any(isinstance(getattr(r, 'glyph', None), Scatter) for r in plot.renderers)
+    ]
+
+    rng = np.random.default_rng(seed)
+    angles = np.linspace(0, 2*np.pi, 20, endpoint=False)
+    latencies = []
+    end = time.perf_counter() + duration
+    while time.perf_counter() < end:
+        plot = plots[rng.integers(len(plots))]
+        x0, y0, radius = rng.normal(0, 1), rng.normal(0, 1), rng.uniform(0.2, 2)
+        event = {
+            "event_name": "selectiongeometry",
+            "event_values": {
+                "model": {"id": plot.id},
+                "geometry": {
+                    "type": "poly",
+                    "x": (x0 + radius*np.cos(angles)).tolist(),
+                    "y": (y0 + radius*np.sin(angles)).tolist(),
+                },
+                "final": True,
+            },
+        }
+        start = time.perf_counter()
+        doc.callbacks.trigger_on_change(MessageSentEvent(doc, "bokeh_event", event))
+        # The server handles the messages of a connection in order, so the
+        # reply to the round trip comes after the selection was applied
+        session.force_roundtrip()
+        latencies.append(time.perf_counter() - start)
+    session.close()
+    queue.put((session_s, latencies))
+
+
+def waitForServer(port, process, timeout=120):
+    end = time.time() + timeout
+    while time.time() < end:
+        if process.poll() is not None:
+            raise RuntimeError("The benchmark server exited with code {}".format(process.returncode))
+        try:
+            urllib.request.urlopen("http://localhost:{}/".format(port), timeout=5).read()
+            return
+        except OSError:
+            time.sleep(0.5)
+    raise RuntimeError("The benchmark server did not start within {} s".format(timeout))
+
+
+def loadtest(workers, rows, params, clients=8, duration=10., port=5007, render="scatter"):
+    """
+    Measures the lasso selection throughput of a BKCorner served from the
+    given number of worker processes (see BKCorner.serve_processes).
+
+    Returns a dict of the results.
+    """
+    # The server runs in its own process group, so the forked workers are
+    # stopped with it
+    process = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "serve", "--workers", str(workers), "--port", str(port),
+         "--rows", str(rows), "--params", str(params), "--render", render],
+        start_new_session=True)
+    try:
+        waitForServer(port, process)
+        queue = multiprocessing.Queue()
+        url = "http://localhost:{}/".format(port)
+        procs = [multiprocessing.Process(target=lassoClient, args=(url, duration, seed, queue)) for seed in range(clients)]
+        start = time.perf_counter()
+        for proc in procs:
+            proc.start()
+        results = [queue.get() for proc in procs]
+        elapsed = time.perf_counter() - start
+        for proc in procs:
+            proc.join()
+    finally:
+        os.killpg(process.pid, signal.SIGTERM)
+        process.wait()
+
+    session_s = np.array([r[0] for r in results])
+    latencies = np.concatenate([r[1] for r in results])
+    return {
+        "workers": workers,
+        "clients": clients,
+        "rows": rows,
+        "params": params,
+        "render": render,
+        "duration_s": elapsed,
+        "selections": len(latencies),
+        "selections_per_s": len(latencies) / elapsed,
+        "latency_s_median": float(np.median(latencies)),
+        "latency_s_p95": float(np.percentile(latencies, 95)),
+        "session_s_median": float(np.median(session_s)),
+    }
+
+
+def serveMain(argv):
+    parser = argparse.ArgumentParser(description="Serve a benchmark BKCorner from several processes")
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--port', type=int, default=5007)
+    parser.add_argument('--rows', type=float, default=1e5)
+    parser.add_argument('--params', type=int, default=4)
+    parser.add_argument('--render', default="scatter")
+    args = parser.parse_args(argv)
+    corner = BKCorner(makeChain(int(args.rows), args.params), output=None, render=args.render)
+    corner.serve_processes(num_procs=args.workers, port=args.port, allow_websocket_origin=["*"])
+
+
+def loadtestMain(argv):
+    parser = argparse.ArgumentParser(description="Selection throughput versus server worker count, as JSON lines")
+    parser.add_argument('--workers', nargs='+', type=int, default=[1, 2, 4, 8])
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=10.)
+    parser.add_argument('--rows', type=float, default=1e5)
+    parser.add_argument('--params', type=int, default=4)
+    parser.add_argument('--render', default="scatter", choices=["scatter"])
+    parser.add_argument('--port', type=int, default=5007)
+    parser.add_argument('--output', default=None, help="Append the results to this file instead of stdout")
+    args = parser.parse_args(argv)
+
+    context = runContext()
+    out = open(args.output, 'a') if args.output is not None else sys.stdout
+    try:
+        for workers in args.workers:
+            result = loadtest(
+                workers, int(args.rows), args.params, clients=args.clients, duration=args.duration,
+                port=args.port, render=args.render)
+            result.update(context)
+            out.write(json.dumps(result) + "\n")
+            out.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) > 0 and argv[0] == "loadtest":
+        return loadtestMain(argv[1:])
+    if len(argv) > 0 and argv[0] == "serve":
+        return serveMain(argv[1:])
+
+    parser = argparse.ArgumentParser(description="Headless BKCorner benchmarks, written as JSON lines")
+    parser.add_argument('--rows', nargs='+', type=float, default=[1e3, 1e4, 1e5, 1e6, 1e7])
+    parser.add_argument('--params', nargs='+', type=int, default=[2, 5, 10, 20, 30])
+    parser.add_argument('--render', nargs='+', default=["scatter"], choices=["scatter", "raster", "lod", "contours"])
+    parser.add_argument('--fractions', nargs='+', type=float, default=[0.001, 0.01, 0.1, 0.5])
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--compact', action='store_true', help="Use compact (float32) columns")
+    parser.add_argument('--no-memory', action='store_true', help="Skip the tracemalloc build")
+    parser.add_argument('--max-values', type=float, default=1e8,
+                        help="Skip runs with more than rows*params values")
+    parser.add_argument('--output', default=None, help="Append the results to this file instead of stdout")
+    args = parser.parse_args(argv)
+
+    context = runContext()
+    out = open(args.output, 'a') if args.output is not None else sys.stdout
+    try:
+        for render in args.render:
+            for params in args.params:
+                for rows in [int(rows) for rows in args.rows]:
+                    if rows*params > args.max_values:
+                        print("Skipping {} rows x {} params (--max-values)".format(rows, params), file=sys.stderr)
+                        continue
+                    kwargs = {"compact": True} if args.compact else {}
+                    result = benchmark(
+                        rows, params, render=render, fractions=args.fractions, repeats=args.repeats,
+                        memory=not args.no_memory, **kwargs)
+                    result.update(context)
+                    out.write(json.dumps(result) + "\n")
+                    out.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+if __name__ == '__main__':
+    main()
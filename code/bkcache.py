@@ -0,0 +1,111 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+
+def nbytes(value):
+    """
+    Returns the memory used by the numpy arrays in a (nested) dict, list, tuple
+    or object attributes (e.g. a GridIndex). Views are not counted, as their
+    memory belongs to the array they were taken from. pandas objects are
+    expected to wrap arrays that are counted elsewhere.
+    """
+    if isinstance(value, np.ndarray):
+        return value.nbytes if value.base is None else 0
+    if isinstance(value, dict):
+        return sum(nbytes(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(nbytes(v) for v in value)
+    if hasattr(value, '__dict__') and not isinstance(value, (pd.DataFrame, pd.Series)):
+        return nbytes(vars(value))
+    return 0
+
+
+def freeze(value):
+    """
+    Marks the numpy arrays in a (nested) dict, list, tuple or object attributes
+    as read-only, so cached arrays can be shared safely between sessions.
+    """
+    if isinstance(value, np.ndarray):
+        value.flags.writeable = False
+    elif isinstance(value, dict):
+        for v in value.values():
+            freeze(v)
+    elif isinstance(value, (list, tuple)):
+        for v in value:
+            freeze(v)
+    elif hasattr(value, '__dict__') and not isinstance(value, (pd.DataFrame, pd.Series)):
+        freeze(vars(value))
+    return value
+
+
+class ArrayCache():
+    """
+    A thread-safe least-recently-used cache of numpy arrays, bounded by the
+    number of bytes held. Values are frozen (read-only) when they are stored.
+    """
+    def __init__(self, max_bytes=2*1024**3):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.sizes = {}
+        self.total_bytes = 0
+        self.lock = threading.RLock()
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.entries:
+                return default
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.evict(key)
+            self.entries[key] = freeze(value)
+            self.sizes[key] = nbytes(value)
+            self.total_bytes += self.sizes[key]
+
+            # Drop the least recently used entries, but always keep the newest one
+            while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+                self.evict(next(iter(self.entries)))
+            return value
+
+    def get_or_compute(self, key, compute):
+        """
+        Returns the cached value for key, calling compute() to create it the
+        first time. The lock is held while computing, so concurrent sessions
+        asking for the same key only compute it once.
+        """
+        with self.lock:
+            if key in self.entries:
+                return self.get(key)
+            return self.put(key, compute())
+
+    def evict(self, key):
+        with self.lock:
+            if key in self.entries:
+                del self.entries[key]
+                self.total_bytes -= self.sizes.pop(key)
+
+    def evict_where(self, match):
+        """
+        Removes every entry whose key satisfies match(key).
+        """
+        with self.lock:
+            for key in [key for key in self.entries if match(key)]:
+                self.evict(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.sizes.clear()
+            self.total_bytes = 0
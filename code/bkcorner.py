@@ -1,95 +1,620 @@
 import numpy as np
 import pandas as pd
+import warnings
+import weakref
+import itertools
+from functools import partial
 
 from bokeh.plotting import show, figure, output_notebook, reset_output
 from bokeh.layouts import gridplot
-from bokeh.models import ColumnDataSource, Span
+from bokeh.layouts import column, row as layout_row
+from bokeh.models import ColumnDataSource, Span, BoxAnnotation, Range1d, LassoSelectTool, RadioButtonGroup, Button
+from bokeh.transform import linear_cmap
+from bokeh.events import Reset, SelectionGeometry
+from bokeh.util.serialization import BINARY_ARRAY_TYPES
 from bokeh.server.server import Server
+from bokeh.protocol import Protocol
+from bokeh.core.properties import validate
+from bokeh.core.property.validation import without_property_validation
+
+from bkraster import RasterPanel, lassoIndices
+from bklod import GridIndex, LodPanel
+from bkkde import ContourPanel, densityContours
+from bkcache import ArrayCache
+from bkstream import ChainStream
+from bkselect import BitMask, combineMasks
+from bkload import loadChain
+from bkmetrics import instrument, timed, messageBytes
+from bkserver import getServer
+
+
+def binIndex(columns, bins=20):
+    """
+    Computes the histogram bin edges for each column and the bin that every
+    sample falls in, so the histograms of any subset of the samples can be built
+    with a single np.bincount() (see selectionHistograms()).
+
+    columns (list): The 1D arrays of samples, one per parameter
+    bins (int): The number of histogram bins per parameter
+
+    Returns the bin edges, shape (Nparam, bins+1), and the bin index of every
+    sample, shape (Nsamples, Nparam). Parameter i uses the indices
+    i*(bins+1) ... i*(bins+1)+bins, where the last one is an overflow bin for
+    samples that can't be binned (e.g. NaN).
+    """
+    Nparam = len(columns)
+    Nsamples = len(columns[0]) if Nparam > 0 else 0
+    dtype = np.uint16 if Nparam*(bins+1) <= np.iinfo(np.uint16).max else np.uint32
+    edges = np.zeros((Nparam, bins+1))
+    bin_index = np.empty((Nsamples, Nparam), dtype=dtype)
+    for i in range(Nparam):
+        values = np.asarray(columns[i], dtype=float)
+        finite = np.isfinite(values)
+        if np.any(finite):
+            lo, hi = np.min(values[finite]), np.max(values[finite])
+        else:
+            lo, hi = 0., 1.
+        if lo == hi:
+            lo, hi = lo - 0.5, hi + 0.5
+        edges[i] = np.linspace(lo, hi, bins+1)
+
+        # Same bin assignment as np.histogram() for uniform bins
+        idx = np.full(Nsamples, bins, dtype=np.intp)
+        vals = values[finite]
+        fidx = ((vals - lo) * (bins / (hi - lo))).astype(np.intp)
+        fidx[fidx == bins] -= 1
+        fidx[vals < edges[i][fidx]] -= 1
+        fidx[(vals >= edges[i][fidx+1]) & (fidx != bins-1)] += 1
+        idx[finite] = fidx
+        bin_index[:,i] = idx + i*(bins+1)
+    return edges, bin_index
+
+
+def selectionHistograms(bin_index, indices, bins=20):
+    """
+    Histograms every parameter for the selected samples in one np.bincount().
+    The cost scales with the number of selected samples.
+
+    bin_index: The bin index array from binIndex()
+    indices: The indices of the selected samples, or None for all samples
+    bins (int): The number of histogram bins per parameter
+
+    Returns the counts, shape (Nparam, bins).
+    """
+    Nparam = bin_index.shape[1]
+    if indices is None:
+        selected = bin_index.ravel()
+    else:
+        selected = bin_index[np.asarray(indices, dtype=np.intp)].ravel()
+    counts = np.bincount(selected, minlength=Nparam*(bins+1))
+    return counts.reshape(Nparam, bins+1)[:,:bins]
+
+
+def selectionQuantiles(values, indices, q=(16, 50, 84)):
+    """
+    Computes the percentiles of every parameter for the selected samples in a
+    single pass over the selection.
+
+    values (2D array): The samples, shape (Nsamples, Nparam)
+    indices: The indices of the selected samples, or None for all samples
+    q (list): The percentiles to compute
+
+    Returns the percentiles, shape (len(q), Nparam).
+    """
+    if indices is not None:
+        values = values[np.asarray(indices, dtype=np.intp)]
+    return np.nanpercentile(values, q, axis=0)
+
+
+def histogramQuantiles(counts, edges, q=(16, 50, 84)):
+    """
+    Approximates the percentiles of every parameter from binned counts by
+    interpolating linearly within the bin that contains each percentile. The
+    cost depends only on the number of bins, so this is used for very large
+    selections.
+
+    counts (2D array): The counts, shape (Nparam, Nbins)
+    edges (2D array): The bin edges, shape (Nparam, Nbins+1)
+    q (list): The percentiles to compute
+
+    Returns the percentiles, shape (len(q), Nparam).
+    """
+    Nparam, Nbins = counts.shape
+    cumulative = np.cumsum(counts, axis=1)
+    quantiles = np.zeros((len(q), Nparam))
+    rows = np.arange(Nparam)
+    for i in range(len(q)):
+        target = q[i] / 100. * cumulative[:,-1]
+        ibin = np.minimum(np.sum(cumulative < target[:,None], axis=1), Nbins-1)
+        below = np.where(ibin > 0, cumulative[rows, ibin-1], 0)
+        frac = (target - below) / np.maximum(counts[rows, ibin], 1)
+        width = edges[rows, ibin+1] - edges[rows, ibin]
+        quantiles[i] = edges[rows, ibin] + np.clip(frac, 0., 1.) * width
+    return quantiles
+
+
+def compactColumns(data):
+    """
+    Converts the columns of a ColumnDataSource data dict to the smallest dtypes
+    that Bokeh sends as binary arrays rather than JSON lists: floats become
+    float32, integers int32 and booleans uint8.
+
+    data (dict): The column name -> array data
+
+    Returns a new dict of C-contiguous numpy arrays.
+    """
+    compact = {}
+    for key in data.keys():
+        column = np.asarray(data[key])
+        if column.dtype.kind == 'f':
+            column = column.astype(np.float32)
+        elif column.dtype.kind in 'iu' and column.dtype not in BINARY_ARRAY_TYPES:
+            column = column.astype(np.int32)
+        elif column.dtype.kind == 'b':
+            column = column.astype(np.uint8)
+        if column.dtype not in BINARY_ARRAY_TYPES:
+            raise ValueError("Column '{}' with dtype {} can't be sent as a binary array".format(key, column.dtype))
+        compact[key] = np.ascontiguousarray(column)
+    return compact
+
+
+def summarizeSelection(state, indices, quantiles="auto", approx_quantile_limit=1000000):
+    """
+    Computes the histograms and 16/50/84 percentiles of the selected samples.
+
+    state (dict): The derived arrays from BKCorner.derived_state()
+    indices: The indices of the selected samples, or None for all samples
+    quantiles (str): 'exact', 'approx' (from the histogram sub-bins) or 'auto'
+        (approximate when more than approx_quantile_limit samples are selected)
+
+    Returns the counts, shape (Nparam, nbins), and the percentiles, shape
+    (3, Nparam).
+    """
+    values, bin_index, fine_edges = state["values"], state["bin_index"], state["fine_edges"]
+    nbins, nsub = state["nbins"], state["nsub"]
+    fine_counts = selectionHistograms(bin_index, indices, bins=nbins*nsub)
+    counts = fine_counts.reshape(len(fine_edges), nbins, nsub).sum(axis=2)
+    Nselected = len(values) if indices is None else len(indices)
+    approx = quantiles == "approx" or (quantiles == "auto" and Nselected > approx_quantile_limit)
+    if approx:
+        return counts, histogramQuantiles(fine_counts, fine_edges)
+    else:
+        return counts, selectionQuantiles(values, indices)
+
+
+def documentPayloadBytes(doc):
+    """
+    Returns the size in bytes of the serialized document, i.e. the
+    PULL-DOC-REPLY message (with the arrays as binary buffers) sent to the
+    browser when a session is opened. Measured like bkmetrics.patchBytes().
+    """
+    return messageBytes(Protocol().create('PULL-DOC-REPLY', "payload", doc))
+
 
 class BKCorner():
+    # Derived arrays shared by all the sessions (documents) of every BKCorner
+    cache = ArrayCache(max_bytes=2*1024**3)
+    plot_counter = itertools.count(1)
+
     def __init__(self, df, params=[], trim_factor=1, logify=False, output='notebook', port=5006, notebook_url="http://localhost:8888", **kwargs):
-        self.df = df.iloc[::trim_factor].reset_index(drop=True)
         self.params = params
         self.logify = logify
         self.kwargs = kwargs
+        self.df = self.load_data(df, trim_factor)
+        self.stream = None
+        self.sessions = {}
+        self.selectors = {}
 
         if output == 'notebook':
             reset_output()
             output_notebook()
             show(self.modify_doc, notebook_url=notebook_url)
         elif output == 'server':
-            reset_output()
-            server = Server({'/': self.modify_doc}, port=port)
-            server.start()
-            try:
-                server.run_until_shutdown()
-            except:
-                print("Server already running")
-            self.server = server
+            self.serve(port)
+            print("Corner plot at {}".format(self.url))
 
-    def modify_doc(self, doc):
-        df, params, logify = self.df, self.params, self.logify
-        if params == []:
-            params = df.columns
+    def serve(self, port=5006, name=None):
+        """
+        Mounts the plot on the shared background server of the port, see
+        bkserver.PlotServer. Returns without blocking.
+
+        port (int): The server port
+        name (str): The plot name in the URL. By default corner<N>.
+        """
+        self.server = getServer(port)
+        if name is None:
+            name = "corner{}".format(next(BKCorner.plot_counter))
+        self.name = name
+        self.url = self.server.add(name, self.modify_doc)
+        return self.url
+
+    def close(self):
+        """
+        Removes the plot from its server.
+        """
+        if getattr(self, "server", None) is not None:
+            self.server.remove(self.name)
+            self.server = None
+
+    def serve_processes(self, num_procs=4, port=5006, **server_kwargs):
+        """
+        Serves the plot from num_procs worker processes sharing one port, with
+        the sessions spread over the workers. Blocks until the server stops.
+
+        The derived arrays are computed before the workers are forked, so the
+        workers share the samples and the derived arrays with the parent
+        through fork's copy-on-write pages, instead of each computing (or
+        unpickling) a copy. Requires a platform that forks (not Windows).
 
+        num_procs (int): The number of worker processes
+        port (int): The server port
+        server_kwargs: Other bokeh Server options
+        """
+        if self.stream is not None:
+            raise ValueError("A streamed chain can't be served from several processes")
+        params, logify = self.plot_params()
+        self.derived_state(params, logify, self.options())
+
+        server = Server({'/': self.modify_doc}, port=port, num_procs=num_procs, **server_kwargs)
+        server.start()
+        server.io_loop.start()
+
+    def set_data(self, df, trim_factor=1):
+        """
+        Replaces the samples. New sessions use the new data and the cached
+        arrays of the old data are dropped.
+        """
+        owner = id(self)
+        self.cache.evict_where(lambda key: key[0] == owner)
+        self.df = self.load_data(df, trim_factor)
+
+    def load_data(self, df, trim_factor=1):
+        """
+        Returns the thinned samples. df is either a DataFrame or the path of a
+        chain file, from which only the plotted parameters (and the weights
+        column) are read, see bkload.loadChain(). Its columns= (the names of
+        a plain 2D .npy or headerless text chain) and key= (the HDF5 group)
+        options are taken from the keyword arguments of the plot.
+        """
+        if isinstance(df, str):
+            params = list(self.params)
+            weights = self.kwargs.get("weights")
+            if params and isinstance(weights, str) and weights not in params:
+                params.append(weights)
+            return loadChain(df, params=params, trim_factor=trim_factor,
+                columns=self.kwargs.get("columns"), key=self.kwargs.get("key"))
+        return df.iloc[::trim_factor].reset_index(drop=True)
+
+    def options(self):
+        """
+        Returns the plotting options, with the defaults for those not given.
+        """
         kwargs = {
             "panel_width": 150,
             "label_all_axes": False,
             "title": False,
+            "quantiles": "auto",
+            "approx_quantile_limit": 1000000,
+            "render": "scatter",
+            "point_budget": 5000,
+            "compact": False,
+            "payload_budget": None,
+            "rollover": None,
+            "burn_in": 0,
+            "combine": "and",
+            "weights": None,
+            "contour_grid": 128,
         }
         for key in self.kwargs.keys():
             kwargs[key] = self.kwargs[key]
+        return kwargs
 
+    def plot_params(self):
+        """
+        Returns the plotted parameters and whether each one is shown as log10.
+        """
+        params, logify = self.params, self.logify
+        if params == []:
+            params = self.df.columns
         if isinstance(logify,bool):
             logify = [logify]*len(params)
-        data = {}
+        return params, logify
+
+    def derived_state(self, params, logify, kwargs):
+        """
+        Returns the arrays derived from the samples (transformed values, bin
+        indices, histograms and quantiles). They are computed once per dataset
+        and shared read-only by every session, so a new session only has to
+        build the Bokeh models.
+        """
+        owner, dataset = id(self), id(self.df)
+        key = (owner, dataset, tuple(params), tuple(logify), kwargs["render"], kwargs["compact"],
+            kwargs["quantiles"], kwargs["approx_quantile_limit"], kwargs["weights"], kwargs["contour_grid"])
+        if key not in self.cache:
+            # Drop anything cached for data this plot no longer shows
+            self.cache.evict_where(lambda k: k[0] == owner and k[1] != dataset)
+            if getattr(self, "_finalizer", None) is None:
+                cache = self.cache
+                self._finalizer = weakref.finalize(self, cache.evict_where, lambda k: k[0] == owner)
+        return self.cache.get_or_compute(key, lambda: self.compute_state(params, logify, kwargs))
+
+    def compute_state(self, params, logify, kwargs):
+        df = self.df
+        Nparam = len(params)
+        values = np.empty((len(df), Nparam), order='F')
+        for i in range(Nparam):
+            if logify[i]:
+                values[:,i] = np.log10(df[params[i]])
+            else:
+                values[:,i] = df[params[i]]
+        data = {params[i]: values[:,i] for i in range(Nparam)}
+
+        # Bin every sample once, so the selection histograms only need a bincount.
+        # The quantiles are approximated from the finer sub-bins when requested.
+        nbins, nsub = 20, 16
+        fine_edges, bin_index = binIndex([data[par] for par in params], bins=nbins*nsub)
+        state = {
+            "values": values,
+            "bin_index": bin_index,
+            "fine_edges": fine_edges,
+            "edges": fine_edges[:,::nsub],
+            "nbins": nbins,
+            "nsub": nsub,
+        }
+        state["full_counts"], state["full_quantiles"] = summarizeSelection(
+            state, None, kwargs["quantiles"], kwargs["approx_quantile_limit"])
+
+        if kwargs["render"] == "raster":
+            state["frame"] = pd.DataFrame(data, copy=False)
+        elif kwargs["render"] == "lod":
+            # One spatial index per panel, and a shared random thinning priority
+            state["priority"] = np.random.default_rng(0).random(len(values), dtype=np.float32)
+            state["grids"] = {}
+            for row in range(Nparam):
+                for col in range(row):
+                    state["grids"][(col,row)] = GridIndex(values[:,col], values[:,row])
+        elif kwargs["render"] == "contours":
+            # Contours of all the samples, on a grid spanning the histogram range
+            edges = state["edges"]
+            state["weights"] = None
+            if kwargs["weights"] is not None:
+                state["weights"] = np.asarray(df[kwargs["weights"]], dtype=float)
+            state["contours"] = {}
+            for row in range(Nparam):
+                for col in range(row):
+                    state["contours"][(col,row)] = densityContours(
+                        values[:,col], values[:,row], edges[col][[0,-1]], edges[row][[0,-1]],
+                        weights=state["weights"], ngrid=kwargs["contour_grid"])
+        elif kwargs["compact"]:
+            state["columns"] = compactColumns(data)
+        else:
+            state["columns"] = data
+        return state
+
+    def stream_state(self, kwargs):
+        """
+        Returns the live state of a streamed chain, with the full-sample
+        quantiles approximated from the running histogram counts.
+        """
+        state = self.stream.state()
+        state["full_quantiles"] = histogramQuantiles(state["fine_counts"], state["fine_edges"])
+        data = {self.stream.params[i]: state["values"][:,i] for i in range(len(self.stream.params))}
+        if kwargs["compact"]:
+            state["columns"] = compactColumns(data)
+        else:
+            state["columns"] = data
+        return state
+
+    def append(self, samples):
+        """
+        Appends samples from a running chain (e.g. an MCMC sampler) to the plot
+        and streams them to every open session. Only the new samples are sent.
+        The histograms and medians are updated from running counts; the
+        "rollover" and "burn_in" options limit the plot to the latest samples
+        and discard the first appended ones. This may be called from any thread.
+
+        samples (DataFrame or dict): The new samples of (at least) the plotted
+            parameters
+        """
+        params, logify = self.plot_params()
+        kwargs = self.options()
+        if kwargs["render"] != "scatter":
+            raise ValueError("append() is only supported with render='scatter'")
+        if self.stream is None:
+            self.stream = ChainStream(
+                self.derived_state(params, logify, kwargs), params,
+                rollover=kwargs["rollover"], burn_in=kwargs["burn_in"])
+
+        values = np.empty((len(samples[params[0]]), len(params)), order='F')
         for i in range(len(params)):
             if logify[i]:
-                data[params[i]] = np.log10(df[params[i]])
+                values[:,i] = np.log10(samples[params[i]])
             else:
-                data[params[i]] = df[params[i]]
-
-        def callback(attr, old, new):
-            indices = source.selected.indices
-            for par in params:
-                old_data = src_hist[par].data
-                edges = np.concatenate([old_data["left"], [old_data["right"][-1]]])
-                hist, edges = np.histogram(data[par][indices], density=False, bins=edges)
-                new_data = {
-                    "top": hist,
-                    "left": edges[:-1],
-                    "right": edges[1:]
-                }   
-
-                src_hist[par].data = new_data
-
-            medians = {par: [np.median(data[par][indices])] for par in params}
-            src_medians.data = medians  
-
-        source = ColumnDataSource(data)
-        src_hist, src_medians = {}, {}
-        for par in params:
-            hist, edges = np.histogram(data[par], density=False, bins=20)
+                values[:,i] = samples[params[i]]
+        values = self.stream.add(values)
+        if len(values) == 0:
+            return
+
+        state = self.stream_state(kwargs)
+        new_data = {params[i]: values[:,i] for i in range(len(params))}
+        if kwargs["compact"]:
+            new_data = compactColumns(new_data)
+        for doc, push in list(self.sessions.items()):
+            doc.add_next_tick_callback(partial(push, new_data, state))
+
+    def select(self, indices, doc=None):
+        """
+        Selects the given samples, as a lasso in one of the panels would.
+
+        indices (array): The indices of the selected samples
+        doc: The session document. All open sessions if None.
+        """
+        docs = list(self.selectors.keys()) if doc is None else [doc]
+        for doc in docs:
+            self.selectors[doc](indices)
+
+    def modify_doc(self, doc):
+        params, logify = self.plot_params()
+        kwargs = self.options()
+        Nparam = len(params)
+        if self.stream is not None:
+            state = self.stream_state(kwargs)
+        else:
+            state = self.derived_state(params, logify, kwargs)
+        edges, full_counts, full_quantiles = state["edges"], state["full_counts"], state["full_quantiles"]
+
+        def summarize(indices):
+            return summarizeSelection(state, indices, kwargs["quantiles"], kwargs["approx_quantile_limit"])
+
+        @without_property_validation
+        def pushStream(new_data, stream_state):
+            nonlocal state
+            Nold, old_edges = len(state["values"]), state["edges"]
+            state = stream_state
+            new_rows = len(new_data[params[0]])
+            source.stream(dict(new_data, selected=np.zeros(new_rows, dtype=np.uint8)), rollover=kwargs["rollover"])
+            rebinned = not np.array_equal(state["edges"], old_edges)
+            for i in range(Nparam):
+                if rebinned:
+                    # The stream widened the edges to fit samples outside them
+                    new_edges = {"left": state["edges"][i][:-1], "right": state["edges"][i][1:]}
+                    src_full[params[i]].data = dict(new_edges, top=state["full_counts"][i])
+                    src_hist[params[i]].data.update(new_edges)
+                else:
+                    src_full[params[i]].data["top"] = state["full_counts"][i]
+            if len(panel_masks) == 0:
+                setQuantileMarkers(state["full_quantiles"])
+            else:
+                # Keep the selections aligned with the rolled over samples
+                Nnew = len(state["values"])
+                dropped = Nold + new_rows - Nnew
+                for key in panel_masks.keys():
+                    panel_masks[key] = panel_masks[key].resized(Nnew, drop=dropped)
+                if rebinned:
+                    applySelection()
+
+        def updateSelection(indices, mask=None):
+            if len(indices) == 0:
+                counts, quantiles = 0*state["full_counts"], state["full_quantiles"]
+            else:
+                counts, quantiles = summarize(indices)
+            for i in range(Nparam):
+                src_hist[params[i]].data["top"] = counts[i]
+            setQuantileMarkers(quantiles)
+            if len(raster_panels) > 0:
+                selected = frame.iloc[indices]
+                for panel in raster_panels:
+                    panel.update(selected)
+            for panel in contour_panels:
+                panel.update(indices)
+            if len(lod_panels) > 0:
+                if mask is None:
+                    mask = BitMask.from_indices(len(state["values"]), indices)
+                for panel in lod_panels:
+                    panel.update(mask)
+            if source is not None:
+                # The selection goes out as one byte per sample in a binary
+                # column, not as a list of indices
+                if mask is None:
+                    mask = BitMask.from_indices(len(state["values"]), indices)
+                with validate(False):
+                    source.data.update(selected=mask.to_bool().view(np.uint8))
+
+        # Cross-filter: each panel's lasso is kept as a bit mask and the masks
+        # are combined with AND/OR (and NOT for inverted panels)
+        panel_masks, inverted, last_panel = {}, set(), []
+        @timed("bkcorner.selection")
+        def applySelection():
+            mask = combineMasks(panel_masks, mode=kwargs["combine"], inverted=inverted)
+            if mask is None:
+                updateSelection([])
+            else:
+                updateSelection(mask.indices(), mask)
+
+        def selectPanel(key, indices):
+            panel_masks[key] = BitMask.from_indices(len(state["values"]), indices)
+            inverted.discard(key)
+            last_panel[:] = [key]
+            applySelection()
+
+        def selectScatterPanel(col, row, event):
+            # Only the samples in the grid cells under the lasso are tested. The
+            # spatial index of a panel is built on its first lasso and cached
+            # for all the sessions, next to the derived arrays of the dataset.
+            # A streamed chain changes with every append, so its lassos test
+            # the samples in the lasso's bounding box without an index.
+            values, grid = state["values"], None
+            if self.stream is None:
+                key = (id(self), id(self.df), "grid", params[col], params[row], logify[col], logify[row])
+                grid = self.cache.get_or_compute(key, lambda: GridIndex(values[:,col], values[:,row]))
+            indices = lassoIndices(event, values[:,col], values[:,row], grid=grid)
+            if indices is not None:
+                selectPanel((col,row), indices)
+
+        def clearSelection(event=None):
+            panel_masks.clear()
+            inverted.clear()
+            applySelection()
+
+        def callback_combine(attr, old, new):
+            kwargs["combine"] = ["and", "or"][new]
+            applySelection()
+
+        def callback_invert():
+            if len(last_panel) > 0 and last_panel[0] in panel_masks:
+                inverted.symmetric_difference_update(last_panel)
+                applySelection()
+
+        # Median lines and 16-84 percentile bands of each parameter, in every panel.
+        # Sub-pixel moves are skipped, as every marker update is a model change.
+        vlines, hlines, vbands, hbands = {}, {}, {}, {}
+        shown = np.full((3, Nparam), np.nan)
+        tolerance = (edges[:,-1] - edges[:,0]) / 1000.
+        def setQuantileMarkers(quantiles):
+            for i in np.flatnonzero(~np.all(np.abs(quantiles - shown) <= tolerance, axis=0)):
+                for span in vlines[params[i]] + hlines[params[i]]:
+                    span.location = quantiles[1,i]
+                for band in vbands[params[i]]:
+                    band.left, band.right = quantiles[0,i], quantiles[2,i]
+                for band in hbands[params[i]]:
+                    band.bottom, band.top = quantiles[0,i], quantiles[2,i]
+                shown[:,i] = quantiles[:,i]
+
+        # Raster and level-of-detail panels are fed from the server, so all the
+        # samples are only sent to the browser when they are scattered
+        raster_panels, lod_panels, contour_panels, source = [], [], [], None
+        if kwargs["render"] == "raster":
+            frame = state["frame"]
+        elif kwargs["render"] not in ["lod", "contours"]:
+            # The cached columns are known to be valid, skip Bokeh's per-element checks
+            with validate(False):
+                source = ColumnDataSource(dict(state["columns"], selected=np.zeros(len(state["values"]), dtype=np.uint8)))
+
+        src_hist, src_full = {}, {}
+        for i in range(Nparam):
+            src_full[params[i]] = ColumnDataSource({
+                "top": full_counts[i],
+                "left": edges[i][:-1],
+                "right": edges[i][1:]
+            })
             hist_df = pd.DataFrame({
-                "top": 0.*hist,
-                "left": edges[:-1],
-                "right": edges[1:]
+                "top": 0*full_counts[i],
+                "left": edges[i][:-1],
+                "right": edges[i][1:]
             })
-            src_hist[par] = ColumnDataSource(hist_df)
-        medians = {par: [np.median(data[par])] for par in params}
-        src_medians = ColumnDataSource(data = medians)
+            src_hist[params[i]] = ColumnDataSource(hist_df)
 
         TOOLS = 'lasso_select, reset'
-        Nparam = len(params)
         ax = np.full((Nparam,Nparam), None).tolist()
         #toggle_botton = Button(label='c')
+        for par in params:
+            vlines[par], hlines[par], vbands[par], hbands[par] = [], [], [], []
         for row in range(Nparam):
             for col in range(row+1):
-                vline = Span(location=medians[params[col]][0], dimension='height', line_color='black', line_width=1.5, line_dash='dashed')
-                hline = Span(location=medians[params[row]][0], dimension='width', line_color='black', line_width=1.5, line_dash='dashed')
-
-                #vline = Span(location=params[col], source=src_medians, dimension='height', line_color='orange', line_width=1.5, line_dash='dashed')
-                #hline = Span(location=row, dimension='width', line_color='orange', line_width=1.5, line_dash='dashed')
+                vline = Span(dimension='height', line_color='black', line_width=1.5, line_dash='dashed')
+                vband = BoxAnnotation(fill_color='black', fill_alpha=0.1, line_alpha=0)
+                vlines[params[col]].append(vline)
+                vbands[params[col]].append(vband)
                 if col==0:
                     width = int(kwargs["panel_width"]*1.25)
                 else:
@@ -99,14 +624,14 @@ class BKCorner():
                 else:
                     height = kwargs["panel_width"]
                 if row == col:
-                    hist, edges = np.histogram(data[params[col]], density=False, bins=20)
                     if kwargs['title']:
                         _title = params[col]
                     else:
                         _title = None
                     ax[row][col] = figure(width=width, height=height, tools=TOOLS, title=_title)
-                    ax[row][col].quad(top=hist, bottom=0, left=edges[:-1], right=edges[1:],
+                    ax[row][col].quad(top="top", bottom=0, left="left", right="right", source=src_full[params[col]],
                            fill_color="navy", line_color="white", alpha=0.5)
+                    ax[row][col].add_layout(vband)
                     ax[row][col].add_layout(vline)
 
                     # Histogram of selected points
@@ -114,13 +639,49 @@ class BKCorner():
                         bottom = 0, top = "top",left = "left", right = "right", source = src_hist[params[col]],
                         fill_color = 'orange', line_color = "white", fill_alpha = 0.5, line_width=0.1)
                 else:
-                    ax[row][col] = figure(width=width, height=height, tools=TOOLS)
-                    ax[row][col].scatter(
-                        params[col],params[row],source=source, size=5,
+                    hline = Span(dimension='width', line_color='black', line_width=1.5, line_dash='dashed')
+                    hband = BoxAnnotation(fill_color='black', fill_alpha=0.1, line_alpha=0)
+                    hlines[params[row]].append(hline)
+                    hbands[params[row]].append(hband)
+                    scatter_kwargs = dict(
+                        size=5,
                         fill_color='blue',line_color='navy', fill_alpha=0.4, line_alpha=0.4,
                         nonselection_fill_color='blue', nonselection_line_color='navy',nonselection_alpha=0.4, nonselection_line_alpha=0.4,
                         selection_fill_color='orange', selection_line_color='orange', selection_alpha=0.5,
                     )
+                    if kwargs["render"] in ["raster", "lod", "contours"]:
+                        ax[row][col] = figure(
+                            width=width, height=height, tools='box_zoom, wheel_zoom, pan, reset',
+                            x_range=Range1d(edges[col][0], edges[col][-1]), y_range=Range1d(edges[row][0], edges[row][-1])
+                        )
+                        # The lasso is evaluated on the server against the full data
+                        if kwargs["render"] == "raster":
+                            ax[row][col].add_tools(LassoSelectTool(renderers=[]))
+                            raster_panels.append(RasterPanel(
+                                ax[row][col], frame, params[col], params[row], on_select=partial(selectPanel, (col,row))))
+                        elif kwargs["render"] == "contours":
+                            ax[row][col].add_tools(LassoSelectTool(renderers=[]))
+                            contour_panels.append(ContourPanel(
+                                ax[row][col], state["values"][:,col], state["values"][:,row], state["contours"][(col,row)],
+                                weights=state["weights"], on_select=partial(selectPanel, (col,row)), ngrid=kwargs["contour_grid"]))
+                        else:
+                            ax[row][col].add_tools(LassoSelectTool())
+                            lod_panels.append(LodPanel(
+                                ax[row][col], state["grids"][(col,row)], params[col], params[row], state["priority"],
+                                point_budget=kwargs["point_budget"], on_select=partial(selectPanel, (col,row)), **scatter_kwargs))
+                    else:
+                        # The lasso is evaluated on the server, which colours the
+                        # selected samples through the "selected" column
+                        ax[row][col] = figure(width=width, height=height, tools='reset')
+                        ax[row][col].add_tools(LassoSelectTool(renderers=[]))
+                        ax[row][col].scatter(params[col], params[row], source=source, **dict(
+                            scatter_kwargs,
+                            fill_color=linear_cmap('selected', ['blue', 'orange'], 0, 1),
+                            line_color=linear_cmap('selected', ['navy', 'orange'], 0, 1)))
+                        ax[row][col].on_event(SelectionGeometry, partial(selectScatterPanel, col, row))
+                    ax[row][col].on_event(Reset, clearSelection)
+                    ax[row][col].add_layout(vband)
+                    ax[row][col].add_layout(hband)
                     ax[row][col].add_layout(vline)
                     ax[row][col].add_layout(hline)
                 if col == 0:
@@ -134,9 +695,31 @@ class BKCorner():
                 if kwargs["label_all_axes"]:
                     ax[row][col].yaxis.axis_label = params[row]
                     ax[row][col].xaxis.axis_label = params[col]
+        setQuantileMarkers(full_quantiles)
         ax_grid = gridplot(ax)
 
-        source.selected.on_change('indices', callback)
+        combine_buttons = RadioButtonGroup(labels=["AND", "OR"], active=["and", "or"].index(kwargs["combine"]), width=120)
+        combine_buttons.on_change('active', callback_combine)
+        invert_button = Button(label="NOT last selection", width=150)
+        invert_button.on_click(callback_invert)
+
+        if source is not None:
+            # Receive the samples passed to append()
+            self.sessions[doc] = pushStream
+        # Let scripts select samples in this session, see select()
+        self.selectors[doc] = partial(selectPanel, "select")
+        def forgetSession(session_context):
+            self.sessions.pop(doc, None)
+            self.selectors.pop(doc, None)
+        doc.on_session_destroyed(forgetSession)
 
         # add the layout to curdoc
-        doc.add_root(ax_grid)
\ No newline at end of file
+        doc.add_root(column(layout_row(combine_buttons, invert_button), ax_grid))
+        instrument(doc)
+
+        if kwargs["compact"] or kwargs["payload_budget"] is not None:
+            self.payload_bytes = documentPayloadBytes(doc)
+            print("Document payload: {:.2f} MB".format(self.payload_bytes/1e6))
+            if kwargs["payload_budget"] is not None and self.payload_bytes > kwargs["payload_budget"]:
+                warnings.warn("Document payload of {} bytes exceeds the budget of {} bytes".format(
+                    self.payload_bytes, kwargs["payload_budget"]))
@@ -0,0 +1,203 @@
+import numpy as np
+
+from bokeh.models import ColumnDataSource
+from bokeh.events import SelectionGeometry
+
+from bkraster import lassoIndices
+
+# The probability mass inside the 1 and 2 sigma contours of a 2D Gaussian
+SIGMA_LEVELS = (1 - np.exp(-0.5), 1 - np.exp(-2.))
+
+
+def binnedKDE(x, y, x_range, y_range, weights=None, ngrid=128, bandwidth=None):
+    """
+    Computes a Gaussian kernel density estimate on a regular grid. The samples
+    are binned onto the grid and the counts are smoothed with an FFT
+    convolution, so the cost is O(Nsamples + ngrid^2 log ngrid) rather than
+    O(Nsamples * ngrid^2) for a per-point KDE.
+
+    x, y (arrays): The coordinates of the samples
+    x_range, y_range (tuples): The (start, end) of the grid on each axis
+    weights (array): Optional sample weights
+    ngrid (int): The number of grid points along each axis
+    bandwidth (tuple): The kernel standard deviation on each axis. If None,
+        Scott's rule is used with the effective number of weighted samples.
+
+    Returns the grid point coordinates (xgrid, ygrid) and the density with
+    shape (ngrid, ngrid), indexed as density[iy, ix].
+    """
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    xgrid = np.linspace(x_range[0], x_range[1], ngrid)
+    ygrid = np.linspace(y_range[0], y_range[1], ngrid)
+    density = np.zeros((ngrid, ngrid))
+    good = np.isfinite(x) & np.isfinite(y)
+    if weights is not None:
+        weights = np.asarray(weights, dtype=float)[good]
+    x, y = x[good], y[good]
+    if len(x) < 2:
+        return xgrid, ygrid, density
+
+    dx = (xgrid[-1] - xgrid[0]) / (ngrid - 1) or 1.
+    dy = (ygrid[-1] - ygrid[0]) / (ngrid - 1) or 1.
+    ix = np.clip(np.rint((x - xgrid[0]) / dx).astype(np.intp), 0, ngrid-1)
+    iy = np.clip(np.rint((y - ygrid[0]) / dy).astype(np.intp), 0, ngrid-1)
+    counts = np.bincount(iy*ngrid + ix, weights=weights, minlength=ngrid*ngrid).reshape(ngrid, ngrid)
+
+    if bandwidth is None:
+        if weights is None:
+            neff = len(x)
+            sx, sy = np.std(x), np.std(y)
+        else:
+            neff = np.sum(weights)**2 / np.sum(weights**2)
+            mx, my = np.average(x, weights=weights), np.average(y, weights=weights)
+            sx = np.sqrt(np.average((x - mx)**2, weights=weights))
+            sy = np.sqrt(np.average((y - my)**2, weights=weights))
+        factor = neff**(-1./6.)
+        bandwidth = (factor*sx or dx, factor*sy or dy)
+
+    # Gaussian kernel in grid units, truncated at 4 sigma
+    kx, ky = bandwidth[0] / dx, bandwidth[1] / dy
+    hx = min(int(np.ceil(4*kx)), ngrid-1)
+    hy = min(int(np.ceil(4*ky)), ngrid-1)
+    gx = np.exp(-0.5 * (np.arange(-hx, hx+1) / max(kx, 1e-3))**2)
+    gy = np.exp(-0.5 * (np.arange(-hy, hy+1) / max(ky, 1e-3))**2)
+    kernel = np.outer(gy, gx)
+    kernel /= kernel.sum()
+
+    # Zero padded FFT convolution, so the density doesn't wrap around the edges
+    shape = (ngrid + 2*hy, ngrid + 2*hx)
+    smooth = np.fft.irfft2(np.fft.rfft2(counts, shape) * np.fft.rfft2(kernel, shape), shape)
+    density = np.maximum(smooth[hy:hy+ngrid, hx:hx+ngrid], 0.)
+    return xgrid, ygrid, density
+
+
+def credibleLevels(density, masses=SIGMA_LEVELS):
+    """
+    Returns the density thresholds that enclose the given fractions of the
+    total probability mass, e.g. the 1 and 2 sigma contours.
+    """
+    values = np.sort(density.ravel())[::-1]
+    cumulative = np.cumsum(values)
+    if len(values) == 0 or cumulative[-1] <= 0:
+        return np.full(len(masses), np.nan)
+    cumulative /= cumulative[-1]
+    idx = np.minimum(np.searchsorted(cumulative, masses), len(values)-1)
+    return values[idx]
+
+
+def contourLines(xgrid, ygrid, density, level):
+    """
+    Traces the contour of density at level with a vectorized marching squares.
+
+    Returns the x and y coordinates of the contour segments as single arrays,
+    with the segments separated by NaN so they can be drawn as one line.
+    """
+    if not np.isfinite(level):
+        return np.zeros(0), np.zeros(0)
+    above = density > level
+    v00, v10 = density[:-1,:-1], density[:-1,1:]
+    v01, v11 = density[1:,:-1], density[1:,1:]
+    a00, a10, a01, a11 = above[:-1,:-1], above[:-1,1:], above[1:,:-1], above[1:,1:]
+    iy, ix = np.nonzero((a00 != a10) | (a00 != a01) | (a11 != a10) | (a11 != a01))
+    if len(iy) == 0:
+        return np.zeros(0), np.zeros(0)
+    v00, v10, v01, v11 = v00[iy,ix], v10[iy,ix], v01[iy,ix], v11[iy,ix]
+    x0, x1 = xgrid[ix], xgrid[ix+1]
+    y0, y1 = ygrid[iy], ygrid[iy+1]
+
+    def cross(va, vb):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.clip((level - va) / (vb - va), 0., 1.)
+
+    # Crossing points on the bottom, right, top and left edges of each cell
+    px = np.stack([x0 + cross(v00, v10)*(x1 - x0), x1 + 0*x0, x0 + cross(v01, v11)*(x1 - x0), x0 + 0*x0], axis=1)
+    py = np.stack([y0 + 0*y0, y0 + cross(v10, v11)*(y1 - y0), y1 + 0*y0, y0 + cross(v00, v01)*(y1 - y0)], axis=1)
+    crosses = np.stack([
+        (v00 > level) != (v10 > level),
+        (v10 > level) != (v11 > level),
+        (v01 > level) != (v11 > level),
+        (v00 > level) != (v01 > level),
+    ], axis=1)
+    ncross = crosses.sum(axis=1)
+
+    # Cells with two crossings give one segment
+    two = ncross == 2
+    edges = np.argsort(~crosses[two], axis=1, kind='stable')[:,:2]
+    rows = np.flatnonzero(two)
+    starts = [(px[rows, edges[:,0]], py[rows, edges[:,0]])]
+    ends = [(px[rows, edges[:,1]], py[rows, edges[:,1]])]
+
+    # Saddle cells give two segments, paired according to the cell center
+    rows = np.flatnonzero(ncross == 4)
+    center_above = (v00[rows] + v10[rows] + v01[rows] + v11[rows]) / 4. > level
+    same = center_above == (v00[rows] > level)
+    pairs = [(0, np.where(same, 1, 3)), (2, np.where(same, 3, 1))]
+    for a, b in pairs:
+        starts.append((px[rows, a], py[rows, a]))
+        ends.append((px[rows, b], py[rows, b]))
+
+    sx = np.concatenate([s[0] for s in starts])
+    sy = np.concatenate([s[1] for s in starts])
+    ex = np.concatenate([e[0] for e in ends])
+    ey = np.concatenate([e[1] for e in ends])
+    nan = np.full(len(sx), np.nan)
+    return np.stack([sx, ex, nan], axis=1).ravel(), np.stack([sy, ey, nan], axis=1).ravel()
+
+
+def densityContours(x, y, x_range, y_range, weights=None, masses=SIGMA_LEVELS, ngrid=128):
+    """
+    Returns the data for a multi_line() ColumnDataSource with one line per
+    credible mass level of the binned KDE of x, y.
+    """
+    xgrid, ygrid, density = binnedKDE(x, y, x_range, y_range, weights=weights, ngrid=ngrid)
+    xs, ys = [], []
+    for level in credibleLevels(density, masses):
+        lx, ly = contourLines(xgrid, ygrid, density, level)
+        xs.append(lx)
+        ys.append(ly)
+    return {'xs': xs, 'ys': ys, 'mass': list(masses)}
+
+
+class ContourPanel():
+    """
+    A corner plot panel that draws the 1 and 2 sigma density contours of all
+    samples and of the selected samples. The render cost depends on the grid
+    size, not on the number of samples.
+    """
+    def __init__(self, p, x, y, contours, weights=None, on_select=None, ngrid=128):
+        """
+        p: The Bokeh figure object, with Range1d x_range and y_range
+        x, y (arrays): The samples of the x-axis,y-axis parameters
+        contours (dict): The precomputed densityContours() of all samples
+        weights (array): Optional sample weights
+        on_select: Called with the indices of the samples inside a lasso
+        ngrid (int): The KDE grid size
+        """
+        self.x, self.y = x, y
+        self.weights = weights
+        self.on_select = on_select
+        self.ngrid = ngrid
+        self.x_range = (p.x_range.start, p.x_range.end)
+        self.y_range = (p.y_range.start, p.y_range.end)
+
+        self.src_all = ColumnDataSource(dict(contours))
+        self.src_selected = ColumnDataSource({'xs': [], 'ys': [], 'mass': []})
+        p.multi_line(xs='xs', ys='ys', source=self.src_all, line_color='navy', line_width=1.5)
+        p.multi_line(xs='xs', ys='ys', source=self.src_selected, line_color='orange', line_width=2)
+        p.on_event(SelectionGeometry, self.callback_select)
+
+    def update(self, indices):
+        """
+        Redraws the contours of the selected samples.
+        """
+        if len(indices) < 2:
+            self.src_selected.data = {'xs': [], 'ys': [], 'mass': []}
+            return
+        weights = None if self.weights is None else self.weights[indices]
+        self.src_selected.data = densityContours(
+            self.x[indices], self.y[indices], self.x_range, self.y_range, weights=weights, ngrid=self.ngrid)
+
+    def callback_select(self, event):
+        indices = lassoIndices(event, self.x, self.y)
+        if indices is not None and self.on_select is not None:
+            self.on_select(indices)
@@ -0,0 +1,139 @@
+import os
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:
+    pq = None
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+
+def loadChain(path, params=None, trim_factor=1, columns=None, key=None):
+    """
+    Loads the chosen parameters of a chain stored on disk without reading the
+    other columns. Where the format allows it (.npy, uncompressed .npz) the
+    columns are memory mapped, and the trim_factor thinning is applied while
+    reading so the skipped samples are never loaded.
+
+    path (str): A .npy, .npz, .parquet, .h5/.hdf5 or text (.csv, .txt) file
+    params (list): The column names to read. All columns if None or empty.
+    trim_factor (int): Keep every trim_factor-th sample
+    columns (list): The column names of a plain 2D .npy array or of a text
+        file without a header
+    key (str): The HDF5 group or compound dataset holding the chain
+
+    Returns a DataFrame with the requested columns.
+    """
+    params = list(params) if params is not None else []
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.npy':
+        data = loadNpy(path, params, trim_factor, columns)
+    elif ext == '.npz':
+        data = loadNpz(path, params, trim_factor)
+    elif ext in ['.parquet', '.pq']:
+        data = loadParquet(path, params, trim_factor)
+    elif ext in ['.h5', '.hdf5', '.hdf']:
+        data = loadHDF5(path, params, trim_factor, key)
+    else:
+        data = loadText(path, params, trim_factor, columns)
+    return pd.DataFrame(data, copy=False)
+
+
+def loadNpy(path, params, trim_factor, columns):
+    array = np.load(path, mmap_mode='r')
+    if array.dtype.names is not None:
+        names = params or list(array.dtype.names)
+        return {name: array[name][::trim_factor] for name in names}
+    if columns is None:
+        raise ValueError("The column names of a 2D .npy chain must be given with columns=")
+    names = params or list(columns)
+    return {name: array[::trim_factor, list(columns).index(name)] for name in names}
+
+
+def loadNpz(path, params, trim_factor):
+    data = {}
+    with np.load(path) as archive, zipfile.ZipFile(path) as zf:
+        names = params or [name for name in archive.files]
+        for name in names:
+            info = zf.getinfo(name + '.npy')
+            if info.compress_type == zipfile.ZIP_STORED:
+                data[name] = memmapZipMember(path, info)[::trim_factor]
+            else:
+                # Compressed members have to be inflated, but only the chosen
+                # ones. The thinned copy lets the full member be freed.
+                member = archive[name]
+                data[name] = member[::trim_factor].copy() if trim_factor > 1 else member
+    return data
+
+
+def memmapZipMember(path, info):
+    """
+    Memory maps an uncompressed .npy member of a .npz archive in place.
+    """
+    with open(path, 'rb') as f:
+        # Skip the zip local file header to the start of the .npy data
+        f.seek(info.header_offset + 26)
+        name_length, extra_length = np.frombuffer(f.read(4), dtype='<u2')
+        f.seek(info.header_offset + 30 + int(name_length) + int(extra_length))
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+    order = 'F' if fortran_order else 'C'
+    return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=shape, order=order)
+
+
+def loadParquet(path, params, trim_factor):
+    if pq is None:
+        raise ImportError("Reading Parquet chains requires pyarrow")
+    pfile = pq.ParquetFile(path)
+    names = params or pfile.schema_arrow.names
+    chunks = {name: [] for name in names}
+
+    # Parquet only reads the chosen column chunks; thin each batch as it arrives
+    offset = 0
+    for batch in pfile.iter_batches(columns=list(names)):
+        start = (-offset) % trim_factor
+        for name in names:
+            chunks[name].append(batch.column(name).to_numpy()[start::trim_factor])
+        offset += batch.num_rows
+    return {name: np.concatenate(chunks[name]) if chunks[name] else np.zeros(0) for name in names}
+
+
+def loadHDF5(path, params, trim_factor, key):
+    if h5py is None:
+        raise ImportError("Reading HDF5 chains requires h5py")
+    data = {}
+    with h5py.File(path, 'r') as f:
+        node = f[key] if key is not None else f
+        if isinstance(node, h5py.Dataset):
+            # A compound (table) dataset; only the chosen fields are read
+            names = params or list(node.dtype.names)
+            for name in names:
+                data[name] = node.fields(name)[::trim_factor]
+        else:
+            # One dataset per column
+            names = params or [name for name in node.keys() if isinstance(node[name], h5py.Dataset)]
+            for name in names:
+                data[name] = node[name][::trim_factor]
+    return data
+
+
+def loadText(path, params, trim_factor, columns):
+    header = None if columns is not None else 'infer'
+    offset = 0 if columns is not None else 1
+    sep = ',' if path.lower().endswith('.csv') else r'\s+'
+    frame = pd.read_csv(
+        path, sep=sep, header=header, names=columns, usecols=params or None,
+        skiprows=lambda i: i >= offset and (i - offset) % trim_factor != 0,
+    )
+    return {name: frame[name].values for name in frame.columns}
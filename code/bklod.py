@@ -0,0 +1,131 @@
+import numpy as np
+
+from bokeh.models import ColumnDataSource
+from bokeh.events import RangesUpdate, SelectionGeometry
+from bokeh.core.properties import validate
+
+from bkraster import lassoIndices
+
+
+class GridIndex():
+    """
+    A uniform grid spatial index of one pair of columns. The samples are sorted
+    by grid cell once, so the samples inside a viewport are found with one
+    contiguous slice per grid row instead of a scan over all samples.
+    """
+    def __init__(self, x, y, ngrid=64):
+        """
+        x, y (arrays): The coordinates of the samples
+        ngrid (int): The number of grid cells along each axis
+        """
+        self.x, self.y = x, y
+        self.ngrid = ngrid
+        finite = np.isfinite(x) & np.isfinite(y)
+        if np.any(finite):
+            self.x0, self.x1 = np.min(x[finite]), np.max(x[finite])
+            self.y0, self.y1 = np.min(y[finite]), np.max(y[finite])
+        else:
+            self.x0, self.x1, self.y0, self.y1 = 0., 1., 0., 1.
+
+        cell = np.full(len(x), ngrid*ngrid, dtype=np.intp)
+        cell[finite] = self.cell(x[finite], 'x') + ngrid*self.cell(y[finite], 'y')
+        dtype = np.int32 if len(x) < np.iinfo(np.int32).max else np.int64
+        self.order = np.argsort(cell, kind='stable').astype(dtype)
+        self.starts = np.searchsorted(cell[self.order], np.arange(ngrid*ngrid+1))
+
+    def cell(self, values, axis):
+        lo, hi = (self.x0, self.x1) if axis == 'x' else (self.y0, self.y1)
+        scale = self.ngrid / (hi - lo) if hi > lo else 0.
+        return np.clip(((values - lo) * scale).astype(np.intp), 0, self.ngrid-1)
+
+    def query(self, x0, x1, y0, y1):
+        """
+        Returns the indices of the samples with x0 <= x <= x1 and y0 <= y <= y1.
+        """
+        if x1 < self.x0 or x0 > self.x1 or y1 < self.y0 or y0 > self.y1:
+            return np.zeros(0, dtype=self.order.dtype)
+        ix0, ix1 = self.cell(np.array([x0, x1]), 'x')
+        iy0, iy1 = self.cell(np.array([y0, y1]), 'y')
+        slices = [self.order[self.starts[iy*self.ngrid+ix0]:self.starts[iy*self.ngrid+ix1+1]] for iy in range(iy0, iy1+1)]
+        candidates = np.concatenate(slices)
+
+        # Only the edge cells can hold samples outside the viewport
+        x, y = self.x[candidates], self.y[candidates]
+        return candidates[(x >= x0) & (x <= x1) & (y >= y0) & (y <= y1)]
+
+
+def thinToBudget(indices, priority, budget):
+    """
+    Keeps at most budget of the indices, choosing the ones with the lowest
+    priority. With a random priority per sample this is a uniform subsample
+    that is consistent between panels and between neighbouring viewports.
+    """
+    if len(indices) <= budget:
+        return indices
+    keep = np.argpartition(priority[indices], budget)[:budget]
+    return np.sort(indices[keep])
+
+
+class LodPanel():
+    """
+    A corner plot panel that scatters at most point_budget samples. On every
+    zoom or pan the samples inside the viewport are looked up in a GridIndex
+    and streamed to the panel, so zoomed-in views show the full data. Lasso
+    selections are evaluated on the server against all samples, not just the
+    ones shown.
+    """
+    def __init__(self, p, grid, x, y, priority, point_budget=5000, on_select=None, **kwargs):
+        """
+        p: The Bokeh figure object, with Range1d x_range and y_range
+        grid (GridIndex): The spatial index of the x,y columns
+        x, y (str): The column names of the x-axis,y-axis data
+        priority (array): The thinning priority of every sample
+        point_budget (int): The maximum number of samples shown
+        on_select: Called with the indices of the samples inside a lasso
+        kwargs: Passed to scatter()
+        """
+        self.p = p
+        self.grid = grid
+        self.x, self.y = x, y
+        self.priority = priority
+        self.point_budget = point_budget
+        self.on_select = on_select
+        self.selected = None
+        self.x_range = (p.x_range.start, p.x_range.end)
+        self.y_range = (p.y_range.start, p.y_range.end)
+
+        self.source = ColumnDataSource()
+        self.update()
+        p.scatter(x, y, source=self.source, **kwargs)
+
+        p.on_event(RangesUpdate, self.callback_ranges)
+        p.on_event(SelectionGeometry, self.callback_select)
+
+    def update(self, selected=None):
+        """
+        Fetches the samples in the current viewport. If a BitMask of the selected
+        samples is given, only the highlighted points are updated.
+        """
+        if selected is None:
+            rows = thinToBudget(
+                self.grid.query(self.x_range[0], self.x_range[1], self.y_range[0], self.y_range[1]),
+                self.priority, self.point_budget)
+            with validate(False):
+                self.source.data = {self.x: self.grid.x[rows], self.y: self.grid.y[rows], 'row': rows}
+        else:
+            self.selected = selected
+        rows = self.source.data['row']
+        if self.selected is not None:
+            self.source.selected.indices = np.flatnonzero(self.selected.test(rows)).tolist()
+        else:
+            self.source.selected.indices = []
+
+    def callback_ranges(self, event):
+        self.x_range = (event.x0, event.x1)
+        self.y_range = (event.y0, event.y1)
+        self.update()
+
+    def callback_select(self, event):
+        indices = lassoIndices(event, self.grid.x, self.grid.y, grid=self.grid)
+        if indices is not None and self.on_select is not None:
+            self.on_select(indices)
@@ -0,0 +1,193 @@
+"""
+Opt-in timing of the server-side callbacks. Set BK_METRICS=1 to record, for
+every instrumented callback, the wall time, how much of it went into
+serializing the document patches, and the bytes pushed to the browser.
+
+BK_METRICS_LOG (float): Seconds between the summaries printed to the log
+    (default 60, 0 to disable)
+BK_METRICS_PORT (int): If set, the summary is also served as JSON at
+    http://localhost:<port>/metrics
+
+When BK_METRICS is not set, timed() returns the callbacks unchanged and
+instrument() does nothing.
+"""
+import json
+import os
+import threading
+import time
+from collections import deque
+from functools import wraps
+
+import numpy as np
+from tornado.ioloop import PeriodicCallback
+from tornado.web import Application, RequestHandler
+
+from bokeh.document.events import DocumentPatchedEvent
+from bokeh.protocol import Protocol
+
+ENABLED = os.environ.get("BK_METRICS", "") not in ("", "0")
+LOG_INTERVAL = float(os.environ.get("BK_METRICS_LOG", 60))
+PORT = int(os.environ.get("BK_METRICS_PORT", 0))
+
+
+class CallbackMetrics():
+    """
+    The recent timings of each named callback, shared by all sessions of the
+    process.
+    """
+    def __init__(self, keep=1000):
+        """
+        keep (int): The number of calls kept per callback
+        """
+        self.keep = keep
+        self.samples = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def active(self):
+        # The records of the callbacks running in this thread, innermost last
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        return self.local.stack
+
+    def record(self, name, wall, serialize, nbytes, pushes):
+        with self.lock:
+            if name not in self.samples:
+                self.samples[name] = deque(maxlen=self.keep)
+            self.samples[name].append((wall, serialize, nbytes, pushes))
+
+    def summary(self):
+        """
+        Returns the call count, the wall, compute and serialization times (in
+        ms) and the bytes pushed per call of each callback.
+        """
+        with self.lock:
+            samples = {name: np.array(self.samples[name], dtype=float) for name in self.samples.keys()}
+        summary = {}
+        for name, values in samples.items():
+            wall, serialize, nbytes, pushes = values.T
+            summary[name] = {
+                "calls": len(values),
+                "wall_ms_median": 1e3*float(np.median(wall)),
+                "wall_ms_p95": 1e3*float(np.percentile(wall, 95)),
+                "wall_ms_max": 1e3*float(np.max(wall)),
+                # The serialization is counted once in the wall time, by the
+                # measurement pass of timed()
+                "compute_ms_mean": 1e3*float(np.mean(np.maximum(wall - serialize, 0.))),
+                "serialize_ms_mean": 1e3*float(np.mean(serialize)),
+                "bytes_mean": float(np.mean(nbytes)),
+                "bytes_max": int(np.max(nbytes)),
+                "pushes_mean": float(np.mean(pushes)),
+            }
+        return summary
+
+    def report(self):
+        lines = ["Callback metrics (ms: median/p95/max wall, mean compute/serialize; pushed bytes mean/max):"]
+        for name, s in sorted(self.summary().items()):
+            lines.append("  {}: {} calls, {:.1f}/{:.1f}/{:.1f}, {:.1f}/{:.1f}; {:.0f}/{}".format(
+                name, s["calls"], s["wall_ms_median"], s["wall_ms_p95"], s["wall_ms_max"],
+                s["compute_ms_mean"], s["serialize_ms_mean"], s["bytes_mean"], s["bytes_max"]))
+        return "\n".join(lines)
+
+
+metrics = CallbackMetrics()
+
+
+def patchBytes(event):
+    """
+    Serializes a document patch the way the server does before sending it.
+
+    Returns the message size in bytes and the time it took.
+    """
+    start = time.perf_counter()
+    nbytes = messageBytes(Protocol().create('PATCH-DOC', [event]))
+    return nbytes, time.perf_counter() - start
+
+
+def messageBytes(msg):
+    """
+    Returns the size in bytes of a Bokeh protocol message as it is sent: the
+    header, metadata and content JSON and the binary buffers.
+    """
+    nbytes = len(msg.header_json) + len(msg.metadata_json) + len(msg.content_json)
+    for header, payload in msg.buffers:
+        nbytes += len(json.dumps(header)) + len(payload)
+    return nbytes
+
+
+def timed(name):
+    """
+    Decorates a callback so its calls are recorded under name.
+    """
+    def decorator(f):
+        if not ENABLED:
+            return f
+
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            stack = metrics.active()
+            entry = {"serialize": 0., "bytes": 0, "pushes": 0}
+            stack.append(entry)
+            start = time.perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                # The wall time includes the pass that serializes the patches to
+                # measure them; summary() separates it out as the serialization cost
+                wall = time.perf_counter() - start
+                stack.pop()
+                metrics.record(name, wall, entry["serialize"], entry["bytes"], entry["pushes"])
+                if len(stack) > 0:
+                    stack[-1]["serialize"] += entry["serialize"]
+        return wrapper
+    return decorator
+
+
+def instrument(doc):
+    """
+    Measures the patches (e.g. source.data assignments) sent from doc while a
+    timed() callback runs, and starts the periodic summaries.
+    """
+    if not ENABLED:
+        return
+
+    def callback_patch(event):
+        stack = metrics.active()
+        if len(stack) == 0 or not isinstance(event, DocumentPatchedEvent):
+            return
+        nbytes, seconds = patchBytes(event)
+        stack[-1]["serialize"] += seconds
+        stack[-1]["bytes"] += nbytes
+        stack[-1]["pushes"] += 1
+
+    doc.on_change(callback_patch)
+    startReporting()
+
+
+_reporting = []
+def startReporting():
+    """
+    Starts the log summary and the metrics endpoint on the current IOLoop,
+    once per process.
+    """
+    if len(_reporting) > 0:
+        return
+    _reporting.append(None)
+
+    if LOG_INTERVAL > 0:
+        def logSummary():
+            if len(metrics.samples) > 0:
+                print(metrics.report())
+        periodic = PeriodicCallback(logSummary, 1e3*LOG_INTERVAL)
+        periodic.start()
+        _reporting.append(periodic)
+
+    if PORT > 0:
+        class MetricsHandler(RequestHandler):
+            def get(self):
+                self.set_header("Content-Type", "application/json")
+                self.write(json.dumps(metrics.summary()))
+        try:
+            _reporting.append(Application([(r"/metrics", MetricsHandler)]).listen(PORT, address="localhost"))
+        except OSError as e:
+            print("Metrics endpoint not started on port {}: {}".format(PORT, e))
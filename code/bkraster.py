@@ -0,0 +1,166 @@
+import numpy as np
+
+from bokeh.models import ColumnDataSource
+from bokeh.events import RangesUpdate, SelectionGeometry
+
+try:
+    import datashader as ds
+    import datashader.transfer_functions as tf
+except ImportError:
+    ds = None
+
+
+def pointsInPolygon(x, y, xs, ys, max_pairs=2**24):
+    """
+    Tests which points lie inside a polygon (even-odd rule). The polygon is cut
+    into horizontal slabs at its vertices; every edge either spans a slab or
+    misses it, so each point is only tested against the edges of its own slab.
+    All the (point, edge) tests run in one vectorized pass, and the work grows
+    with the number of points times the number of edges a horizontal line
+    crosses, not with the number of vertices.
+
+    x, y (arrays): The coordinates of the points
+    xs, ys (lists): The vertices of the polygon, e.g. from a lasso selection
+    max_pairs (int): The most (point, edge) tests done at once
+
+    Returns a boolean mask with the same length as x.
+    """
+    x, y = np.asarray(x), np.asarray(y)
+    xs, ys = np.asarray(xs, dtype=float), np.asarray(ys, dtype=float)
+    inside = np.zeros(len(x), dtype=bool)
+    if len(xs) < 3:
+        return inside
+
+    # Only the points in the bounding box of the polygon need to be tested
+    candidates = np.flatnonzero((x >= xs.min()) & (x <= xs.max()) & (y >= ys.min()) & (y <= ys.max()))
+    px, py = x[candidates], y[candidates]
+
+    # Edge i runs from vertex i-1 to vertex i. A point is level with it if
+    # (y0 > py) != (y1 > py), i.e. min(y0, y1) <= py < max(y0, y1)
+    x0, y0, x1, y1 = np.roll(xs, 1), np.roll(ys, 1), xs, ys
+    keep = y0 != y1
+    x0, y0, x1, y1 = x0[keep], y0[keep], x1[keep], y1[keep]
+    slabs = np.unique(ys)
+    spans = (np.minimum(y0, y1)[None,:] <= slabs[:,None]) & (np.maximum(y0, y1)[None,:] > slabs[:,None])
+    slab_edges = np.nonzero(spans)[1]
+    nedges = spans.sum(axis=1)
+    first_edge = np.cumsum(nedges) - nedges
+
+    slab = np.searchsorted(slabs, py, side='right') - 1
+    chunk = max(1, max_pairs // max(1, int(nedges.max())))
+    crossings = np.zeros(len(candidates), dtype=np.intp)
+    for start in range(0, len(candidates), chunk):
+        s = slab[start:start+chunk]
+        n = nedges[s]
+        rows = np.repeat(np.arange(start, start + len(s)), n)
+        within = np.arange(len(rows)) - np.repeat(np.cumsum(n) - n, n)
+        edge = slab_edges[np.repeat(first_edge[s], n) + within]
+        xcross = x0[edge] + (py[rows] - y0[edge]) * (x1[edge] - x0[edge]) / (y1[edge] - y0[edge])
+        crossings += np.bincount(rows[px[rows] < xcross], minlength=len(candidates))
+    inside[candidates] = crossings % 2 == 1
+    return inside
+
+
+def lassoIndices(event, x, y, grid=None):
+    """
+    Finds the samples inside a lasso, the shared body of the panels'
+    SelectionGeometry callbacks.
+
+    event (SelectionGeometry): The selection event
+    x, y (arrays): The coordinates of the samples
+    grid (GridIndex): A spatial index of x, y. Only the samples in the grid
+        cells under the lasso are tested if given.
+
+    Returns the sorted indices of the samples inside the lasso, or None if the
+    event is not a finished lasso.
+    """
+    geometry = event.geometry
+    if not event.final or geometry.get('type') != 'poly':
+        return None
+    xs, ys = geometry['x'], geometry['y']
+    if grid is None:
+        return np.flatnonzero(pointsInPolygon(x, y, xs, ys))
+    candidates = grid.query(min(xs), max(xs), min(ys), max(ys))
+    inside = pointsInPolygon(x[candidates], y[candidates], xs, ys)
+    return np.sort(candidates[inside])
+
+
+def densityImage(frame, x, y, x_range, y_range, width, height, cmap):
+    """
+    Aggregates the points onto a width x height grid with datashader and shades
+    the counts into an RGBA image.
+
+    frame (DataFrame): The samples
+    x, y (str): The column names of the x-axis,y-axis data
+    x_range, y_range (tuples): The (start, end) of the image on each axis
+    width, height (int): The size of the image in pixels
+    cmap (list): The colormap passed to datashader's shade()
+
+    Returns the data for a ColumnDataSource used by image_rgba().
+    """
+    x0, x1 = x_range
+    y0, y1 = y_range
+    image = np.zeros((height, width), dtype=np.uint32)
+    if len(frame) > 0:
+        canvas = ds.Canvas(plot_width=width, plot_height=height, x_range=(x0, x1), y_range=(y0, y1))
+        agg = canvas.points(frame, x, y)
+        if agg.values.any():
+            image = tf.shade(agg, cmap=cmap, how='eq_hist', min_alpha=60).data
+    return {'image': [image], 'x': [x0], 'y': [y0], 'dw': [x1 - x0], 'dh': [y1 - y0]}
+
+
+class RasterPanel():
+    """
+    A corner plot panel that shows server-side density images of all samples
+    and of the selected samples instead of scattering every point. The images
+    are re-aggregated at full resolution whenever the panel is zoomed or panned.
+    """
+    def __init__(self, p, frame, x, y, on_select=None):
+        """
+        p: The Bokeh figure object, with Range1d x_range and y_range
+        frame (DataFrame): The samples
+        x, y (str): The column names of the x-axis,y-axis data
+        on_select: Called with the indices of the samples inside a lasso
+        """
+        if ds is None:
+            raise ImportError("render='raster' requires datashader")
+        self.p = p
+        self.frame = frame
+        self.x, self.y = x, y
+        self.on_select = on_select
+        self.selected = frame.iloc[:0]
+        self.width, self.height = p.plot_width, p.plot_height
+        self.x_range = (p.x_range.start, p.x_range.end)
+        self.y_range = (p.y_range.start, p.y_range.end)
+
+        self.src_all = ColumnDataSource()
+        self.src_selected = ColumnDataSource()
+        self.update()
+        p.image_rgba(image='image', x='x', y='y', dw='dw', dh='dh', source=self.src_all)
+        p.image_rgba(image='image', x='x', y='y', dw='dw', dh='dh', source=self.src_selected)
+
+        p.on_event(RangesUpdate, self.callback_ranges)
+        p.on_event(SelectionGeometry, self.callback_select)
+
+    def update(self, selected=None):
+        """
+        Re-aggregates the images for the current ranges. If a DataFrame of the
+        selected samples is given, only the selection image is redrawn.
+        """
+        if selected is None:
+            self.src_all.data = densityImage(
+                self.frame, self.x, self.y, self.x_range, self.y_range, self.width, self.height, ['lightblue', 'navy'])
+        else:
+            self.selected = selected
+        self.src_selected.data = densityImage(
+            self.selected, self.x, self.y, self.x_range, self.y_range, self.width, self.height, ['orange', 'darkorange'])
+
+    def callback_ranges(self, event):
+        self.x_range = (event.x0, event.x1)
+        self.y_range = (event.y0, event.y1)
+        self.update()
+
+    def callback_select(self, event):
+        indices = lassoIndices(event, self.frame[self.x].values, self.frame[self.y].values)
+        if indices is not None and self.on_select is not None:
+            self.on_select(indices)
@@ -0,0 +1,103 @@
+import numpy as np
+
+
+class BitMask():
+    """
+    A selection of samples stored as a packed bit array, one bit per sample.
+    AND/OR/NOT are done on the packed bytes, so combining selections of a
+    multi-million sample chain touches a few hundred KB instead of lists of
+    Python ints.
+    """
+    def __init__(self, n, bits=None):
+        """
+        n (int): The number of samples
+        bits (array): The packed uint8 bits, from np.packbits. Empty if None.
+        """
+        self.n = n
+        if bits is None:
+            bits = np.zeros((n + 7) // 8, dtype=np.uint8)
+        self.bits = bits
+
+    @classmethod
+    def from_indices(cls, n, indices):
+        mask = np.zeros(n, dtype=bool)
+        mask[np.asarray(indices, dtype=np.intp)] = True
+        return cls(n, np.packbits(mask))
+
+    @classmethod
+    def from_bool(cls, mask):
+        return cls(len(mask), np.packbits(mask))
+
+    def __and__(self, other):
+        return BitMask(self.n, self.bits & other.bits)
+
+    def __or__(self, other):
+        return BitMask(self.n, self.bits | other.bits)
+
+    def __invert__(self):
+        bits = ~self.bits
+        # Keep the padding bits past the last sample cleared
+        if self.n % 8:
+            bits[-1] &= np.uint8(0xff << (8 - self.n % 8) & 0xff)
+        return BitMask(self.n, bits)
+
+    def __len__(self):
+        return self.n
+
+    @property
+    def nbytes(self):
+        return self.bits.nbytes
+
+    def count(self):
+        return int(np.unpackbits(self.bits).sum())
+
+    def to_bool(self):
+        return np.unpackbits(self.bits, count=self.n).astype(bool)
+
+    def indices(self):
+        return np.flatnonzero(np.unpackbits(self.bits, count=self.n))
+
+    def test(self, rows):
+        """
+        Returns whether each of the given samples is selected, without
+        unpacking the whole mask.
+        """
+        rows = np.asarray(rows, dtype=np.intp)
+        return ((self.bits[rows >> 3] >> (7 - (rows & 7))) & 1).astype(bool)
+
+    def resized(self, n, drop=0):
+        """
+        Returns the mask after the first drop samples were removed and the
+        remaining ones were padded with unselected samples to n in total.
+        """
+        if drop == 0 and n >= self.n and self.n % 8 == 0:
+            bits = np.zeros((n + 7) // 8, dtype=np.uint8)
+            bits[:len(self.bits)] = self.bits
+            return BitMask(n, bits)
+        mask = np.zeros(n, dtype=bool)
+        old = self.to_bool()[drop:drop+n]
+        mask[:len(old)] = old
+        return BitMask.from_bool(mask)
+
+
+def combineMasks(masks, mode="and", inverted=()):
+    """
+    Combines the per-panel selections like a cross-filter.
+
+    masks (dict): The BitMask of each panel that has a selection
+    mode (str): 'and' keeps the samples selected in every panel, 'or' the
+        samples selected in any panel
+    inverted (set): The panels whose selection is negated (NOT)
+
+    Returns the combined BitMask, or None if no panel has a selection.
+    """
+    combined = None
+    for key in masks.keys():
+        mask = ~masks[key] if key in inverted else masks[key]
+        if combined is None:
+            combined = mask
+        elif mode == "or":
+            combined = combined | mask
+        else:
+            combined = combined & mask
+    return combined
@@ -0,0 +1,151 @@
+"""
+A Bokeh server running on a background thread, that serves any number of
+plots (modify_doc callables) from one port. Plots can be added and removed
+while it runs, without blocking the calling notebook or script:
+
+    server = getServer(5006)
+    url = server.add("corner", corner.modify_doc)
+    ...
+    server.remove("corner")
+"""
+import asyncio
+import threading
+from urllib.parse import quote
+
+from tornado.ioloop import IOLoop
+from tornado.web import RequestHandler
+
+from bokeh.application import Application
+from bokeh.application.handlers import FunctionHandler
+from bokeh.models import Div
+from bokeh.server.server import Server
+
+
+class PlotServer():
+    """
+    A Bokeh server on its own IOLoop thread. All plots are served by a single
+    dispatcher application at /plot?plot=<name>, so adding a plot is just a
+    dict update and needs no new routes or server. /plots/<name> redirects to
+    the plot and / lists the mounted plots.
+    """
+    def __init__(self, port=5006, address="localhost", **kwargs):
+        """
+        port (int): The port to listen on, 0 for any free port
+        address (str): The address to listen on
+        kwargs: Other bokeh Server options, e.g. allow_websocket_origin
+        """
+        self.plots = {}
+        self.lock = threading.Lock()
+        self.server = None
+        self.io_loop = None
+        self.error = None
+        ready = threading.Event()
+        self.thread = threading.Thread(
+            target=self.run, args=(port, address, kwargs, ready), name="bkserver-{}".format(port), daemon=True)
+        self.thread.start()
+        ready.wait()
+        if self.error is not None:
+            raise self.error
+
+    def run(self, port, address, kwargs, ready):
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        self.io_loop = IOLoop.current()
+        plots = self
+        class IndexHandler(RequestHandler):
+            def get(self):
+                links = ['<li><a href="{0}">{1}</a></li>'.format(plots.path(name), name) for name in plots.names()]
+                self.write("<html><body><ul>{}</ul></body></html>".format("".join(links)))
+        class RedirectHandler(RequestHandler):
+            def get(self, name):
+                if name not in plots.names():
+                    self.send_error(404)
+                else:
+                    self.redirect(plots.path(name))
+        try:
+            self.server = Server(
+                {'/plot': Application(FunctionHandler(self.modify_doc))}, io_loop=self.io_loop,
+                port=port, address=address,
+                extra_patterns=[(r"/", IndexHandler), (r"/plots/([^/]+)/?", RedirectHandler)], **kwargs)
+            self.server.start()
+        except Exception as e:
+            self.error = e
+            ready.set()
+            return
+        ready.set()
+        self.io_loop.start()
+
+    def modify_doc(self, doc):
+        # Build the plot named in the request
+        arguments = doc.session_context.request.arguments
+        name = arguments.get("plot", [b""])[0]
+        name = name.decode() if isinstance(name, bytes) else name
+        with self.lock:
+            modify_doc = self.plots.get(name)
+        if modify_doc is None:
+            doc.add_root(Div(text="No plot named '{}'".format(name)))
+        else:
+            modify_doc(doc)
+
+    @property
+    def port(self):
+        return self.server.port
+
+    def names(self):
+        with self.lock:
+            return list(self.plots.keys())
+
+    def path(self, name):
+        return "/plot?plot={}".format(quote(name))
+
+    def url(self, name):
+        return "http://{}:{}{}".format(self.server.address or "localhost", self.port, self.path(name))
+
+    def add(self, name, modify_doc):
+        """
+        Mounts a plot, replacing any plot with the same name. Sessions opened
+        from then on use the new modify_doc.
+
+        name (str): The plot name
+        modify_doc: The function that builds the plot into a Document
+
+        Returns the URL of the plot.
+        """
+        with self.lock:
+            self.plots[name] = modify_doc
+        return self.url(name)
+
+    def remove(self, name):
+        """
+        Unmounts a plot. Its open sessions keep working until they are closed.
+        """
+        with self.lock:
+            self.plots.pop(name, None)
+
+    def stop(self):
+        """
+        Stops the server and its thread.
+        """
+        def stopServer():
+            self.server.stop()
+            self.io_loop.stop()
+        self.io_loop.add_callback(stopServer)
+        self.thread.join()
+        with _lock:
+            if _servers.get(self.port) is self:
+                del _servers[self.port]
+
+
+_servers = {}
+_lock = threading.Lock()
+def getServer(port=5006, **kwargs):
+    """
+    Returns the PlotServer running on port in this process, starting it the
+    first time.
+    """
+    with _lock:
+        if port not in _servers or not _servers[port].thread.is_alive():
+            server = PlotServer(port=port, **kwargs)
+            _servers[server.port] = server
+            if port != server.port:
+                _servers[port] = server
+        return _servers[port]
@@ -0,0 +1,160 @@
+import threading
+
+import numpy as np
+
+
+def binColumn(values, edges):
+    """
+    Returns the fine bin of each value, with len(edges)-1 for the values that
+    can't be binned (outside the edges or not finite).
+    """
+    Nfine = len(edges) - 1
+    idx = np.searchsorted(edges, values, side='right') - 1
+    idx[values == edges[-1]] = Nfine - 1
+    idx[(idx < 0) | (idx >= Nfine) | ~np.isfinite(values)] = Nfine
+    return idx
+
+
+class ChainStream():
+    """
+    The growing sample buffer and running histogram counts of a corner plot
+    that is fed from a running chain. Appending costs O(new samples), the
+    histograms and medians are updated from the running counts instead of
+    being recomputed over the full history.
+
+    When new samples fall outside the bin edges of a parameter (e.g. a chain
+    that is still converging), the edges of that parameter are widened and
+    its live samples re-binned, so no finite sample is left out of the
+    histograms and quantiles. The edges grow with a margin, so re-binning
+    happens O(log) times for a drifting chain.
+    """
+    def __init__(self, state, params, rollover=None, burn_in=0):
+        """
+        state (dict): The derived arrays of the initial samples, from
+            BKCorner.derived_state(). Their bin edges are the starting edges.
+        params (list): The parameter names, in the order of the state columns
+        rollover (int): If given, only the latest rollover samples are kept
+        burn_in (int): The number of appended samples to discard
+        """
+        self.params = list(params)
+        self.rollover = rollover
+        self.burn_in = burn_in
+        self.lock = threading.Lock()
+        self.nbins, self.nsub = state["nbins"], state["nsub"]
+        self.fine_edges = np.array(state["fine_edges"])
+        self.edges = self.fine_edges[:,::self.nsub]
+        Nfine = self.nbins*self.nsub
+
+        n = len(state["values"])
+        capacity = max(1024, 2*n)
+        self.values = np.empty((capacity, len(self.params)), order='F')
+        self.bin_index = np.empty((capacity, len(self.params)), dtype=state["bin_index"].dtype)
+        self.values[:n] = state["values"]
+        self.bin_index[:n] = state["bin_index"]
+        self.start, self.n = 0, n
+        self.counts = np.bincount(self.bin_index[:n].ravel(), minlength=len(self.params)*(Nfine+1))
+        self.trim()
+
+    def state(self):
+        """
+        Returns the live samples in the same form as BKCorner.derived_state(),
+        with the running fine_counts in place of the full-sample quantiles.
+        """
+        with self.lock:
+            fine_counts = self.fine_counts()
+            return {
+                "values": self.values[self.start:self.n],
+                "bin_index": self.bin_index[self.start:self.n],
+                "fine_edges": self.fine_edges,
+                "edges": self.edges,
+                "nbins": self.nbins,
+                "nsub": self.nsub,
+                "fine_counts": fine_counts,
+                "full_counts": fine_counts.reshape(len(self.params), self.nbins, self.nsub).sum(axis=2),
+            }
+
+    def fine_counts(self):
+        Nfine = self.nbins*self.nsub
+        return self.counts.reshape(len(self.params), Nfine+1)[:,:Nfine]
+
+    def add(self, values):
+        """
+        Appends new samples.
+
+        values (2D array): The new samples, shape (Nnew, Nparam), already
+            transformed (e.g. log10) like the plotted columns
+
+        Returns the samples that were kept after the burn-in.
+        """
+        with self.lock:
+            skip = min(self.burn_in, len(values))
+            self.burn_in -= skip
+            values = values[skip:]
+            if len(values) == 0:
+                return values
+
+            Nfine = self.nbins*self.nsub
+            bin_index = np.empty(values.shape, dtype=self.bin_index.dtype)
+            for i in range(len(self.params)):
+                finite = values[np.isfinite(values[:,i]), i]
+                if len(finite) > 0:
+                    lo, hi = np.min(finite), np.max(finite)
+                    if lo < self.fine_edges[i][0] or hi > self.fine_edges[i][-1]:
+                        self.rebin(i, lo, hi)
+                bin_index[:,i] = binColumn(values[:,i], self.fine_edges[i]) + i*(Nfine+1)
+
+            self.reserve(len(values))
+            self.values[self.n:self.n+len(values)] = values
+            self.bin_index[self.n:self.n+len(values)] = bin_index
+            self.n += len(values)
+            self.counts += np.bincount(bin_index.ravel(), minlength=len(self.counts))
+            self.trim()
+            return values
+
+    def rebin(self, i, lo, hi, margin=0.25):
+        """
+        Widens the bin edges of parameter i to include lo...hi, plus margin
+        times the new range on the side(s) that grew, and re-bins its live
+        samples.
+        """
+        Nfine = self.nbins*self.nsub
+        old_lo, old_hi = self.fine_edges[i][0], self.fine_edges[i][-1]
+        new_lo, new_hi = min(old_lo, lo), max(old_hi, hi)
+        span = new_hi - new_lo
+        if lo < old_lo:
+            new_lo -= margin*span
+        if hi > old_hi:
+            new_hi += margin*span
+        # New arrays, as the states handed out keep referencing the old edges
+        # and bin indices
+        self.fine_edges = self.fine_edges.copy()
+        self.fine_edges[i] = np.linspace(new_lo, new_hi, Nfine+1)
+        self.edges = self.fine_edges[:,::self.nsub]
+        self.bin_index = self.bin_index.copy(order='K')
+
+        idx = binColumn(self.values[self.start:self.n, i], self.fine_edges[i])
+        self.bin_index[self.start:self.n, i] = idx + i*(Nfine+1)
+        self.counts[i*(Nfine+1):(i+1)*(Nfine+1)] = np.bincount(idx, minlength=Nfine+1)
+
+    def trim(self):
+        # Remove the samples that rolled over from the running counts
+        if self.rollover is not None and self.n - self.start > self.rollover:
+            old = self.bin_index[self.start:self.n-self.rollover]
+            self.counts -= np.bincount(old.ravel(), minlength=len(self.counts))
+            self.start = self.n - self.rollover
+
+    def reserve(self, Nnew):
+        # Drop the rolled over samples or grow the buffers, amortized O(1) per sample
+        live = self.n - self.start
+        if self.n + Nnew <= len(self.values):
+            return
+        if self.start > 0 and live + Nnew <= len(self.values) // 2:
+            capacity = len(self.values)
+        else:
+            capacity = max(2*len(self.values), 2*(live + Nnew))
+        values = np.empty((capacity, len(self.params)), order='F')
+        bin_index = np.empty((capacity, len(self.params)), dtype=self.bin_index.dtype)
+        values[:live] = self.values[self.start:self.n]
+        bin_index[:live] = self.bin_index[self.start:self.n]
+        self.values, self.bin_index = values, bin_index
+        self.start, self.n = 0, live
@@ -1,20 +1,57 @@
 import numpy as np
-import pandas as pd
+from functools import partial
 
-from bokeh.plotting import show, figure, output_notebook, reset_output
-from bokeh.layouts import gridplot
-from bokeh.models import ColumnDataSource, Span
+from bokeh.models import ColumnDataSource
+from bokeh.document.events import ColumnDataChangedEvent, ColumnsStreamedEvent, ColumnsPatchedEvent
 
-from bokeh.server.server import Server
-from functools import partial
-from bokeh.application.handlers import FunctionHandler
-from bokeh.application import Application
+from bokeh.util.browser import view
+
+import bkcorner
+
+
+def errorBarData(data, x, y, xerr=None, yerr=None):
+    """
+    Returns the endpoint columns of the error bars, one row per data point.
+
+    data (dict): The source data
+    x, y (str): The column name of the x-axis,y-axis data
+    xerr, yerr (lists): The column names for the [low, high] errorbar on x,y,
+        or None for no error bars
+    """
+    xvals = np.asarray(data[x], dtype=float)
+    yvals = np.asarray(data[y], dtype=float)
+    bars = {"x": xvals, "y": yvals}
+    if xerr is not None:
+        bars["x_lo"] = xvals - np.asarray(data[xerr[0]], dtype=float)
+        bars["x_hi"] = xvals + np.asarray(data[xerr[1]], dtype=float)
+    if yerr is not None:
+        bars["y_lo"] = yvals - np.asarray(data[yerr[0]], dtype=float)
+        bars["y_hi"] = yvals + np.asarray(data[yerr[1]], dtype=float)
+    return bars
+
+
+def patchedRows(patches, n):
+    """
+    Returns the sorted rows changed by the patches of a ColumnDataSource.patch()
+    with n rows. The indices are ints, slices or (row, ...) tuples.
+    """
+    rows = []
+    for changes in patches.values():
+        for index, value in changes:
+            if isinstance(index, tuple):
+                index = index[0]
+            if isinstance(index, slice):
+                rows.extend(range(*index.indices(n)))
+            else:
+                rows.append(index)
+    return np.unique(np.asarray(rows, dtype=np.intp) % max(n, 1))
 
 
 def addErrorBars(p, source, x, y, xerr=[], yerr=[], **kwargs):
     """
-    Computes the coordinates for each error bar and adds them to a figure using
-    multi_line(). xerr and yerr 
+    Adds error bars to a figure as segment() glyphs, drawn from a second
+    ColumnDataSource with the endpoints of each bar. The error bars are kept
+    up to date when source is changed, streamed to or patched.
 
     p: The Bokeh figure object
     source: The ColumnDataSource object with the data
@@ -23,11 +60,11 @@ def addErrorBars(p, source, x, y, xerr=[], yerr=[], **kwargs):
         symmetrical, this can be length 1. If nothing is provided, the code will
         attempt to determine the column names. If None or False, no x,y error 
         bars will be drawn.
+
+    Returns the segment renderers.
     """
     data = source.data
 
-    errs_x, errs_y = [], []
-    
     # If xerr and yerr aren't provided (and aren't 'None'), try to figure out the values automatically
     if xerr not in [None,False]:
         if len(xerr) == 0:
@@ -45,153 +82,64 @@ def addErrorBars(p, source, x, y, xerr=[], yerr=[], **kwargs):
                 yerr = [y+"_err",y+"_err"]
             else:
                 yerr = None
-
-    # Loop over each entry and set the coordinates of a horizontal errorbar line
-    if xerr not in [None,False]:
-        if len(xerr) == 1:
-            xerr = [xerr[0],xerr[0]]
-        for i in range(len(data[x])):
-            errs_x.append([data[x][i] - data[xerr[0]][i], data[x][i] + data[xerr[1]][i]])
-            errs_y.append([data[y][i], data[y][i]])
-    # Repeat for the y errors
-    if yerr not in [None,False]:
-        if len(yerr) == 1:
-            yerr = [yerr[0],yerr[0]]
-        for i in range(len(data[x])):
-            errs_x.append([data[x][i], data[x][i]])
-            errs_y.append([data[y][i] - data[yerr[0]][i], data[y][i] + data[yerr[1]][i]])
-    p.multi_line(errs_x, errs_y, **kwargs)
-
-
-class BKCorner():
+    xerr = None if xerr in [None,False] else [xerr[0], xerr[-1]]
+    yerr = None if yerr in [None,False] else [yerr[0], yerr[-1]]
+
+    src_err = ColumnDataSource(errorBarData(data, x, y, xerr, yerr))
+    renderers = []
+    if xerr is not None:
+        renderers.append(p.segment(x0="x_lo", y0="y", x1="x_hi", y1="y", source=src_err, **kwargs))
+    if yerr is not None:
+        renderers.append(p.segment(x0="x", y0="y_lo", x1="x", y1="y_hi", source=src_err, **kwargs))
+
+    columns = [x, y] + (xerr or []) + (yerr or [])
+    def applyHint(hint):
+        # Mirror a stream or patch of source on src_err, so only the changed
+        # bars are recomputed and sent
+        if isinstance(hint, ColumnsStreamedEvent):
+            src_err.stream(errorBarData(hint.data, x, y, xerr, yerr), rollover=hint.rollover)
+        elif isinstance(hint, ColumnsPatchedEvent):
+            rows = patchedRows({col: hint.patches[col] for col in columns if col in hint.patches}, len(src_err.data["x"]))
+            if len(rows) > 0:
+                bars = errorBarData({col: np.asarray(source.data[col])[rows] for col in columns}, x, y, xerr, yerr)
+                src_err.patch({key: list(zip(rows.tolist(), bars[key].tolist())) for key in bars.keys()})
+        elif not (isinstance(hint, ColumnDataChangedEvent) and hint.cols is not None and set(hint.cols).isdisjoint(columns)):
+            src_err.data = errorBarData(source.data, x, y, xerr, yerr)
+
+    # The stream/patch hint only reaches the document's on_change callbacks,
+    # which are registered once the source is in a document. Until then, the
+    # bars are recomputed from all the rows.
+    docs = []
+    def callback_document(event):
+        if getattr(event, "model", None) is source and getattr(event, "attr", None) == "data":
+            applyHint(event.hint)
+
+    def watchDocument(doc):
+        if doc not in docs and source.document is doc:
+            docs.append(doc)
+            doc.on_change(callback_document)
+
+    def callback_data(attr, old, new):
+        doc = source.document
+        if doc is not None and doc in docs:
+            return
+        src_err.data = errorBarData(source.data, x, y, xerr, yerr)
+        if doc is not None:
+            # Not during this change event, which is iterating over the
+            # document's callbacks
+            doc.add_next_tick_callback(partial(watchDocument, doc))
+    source.on_change('data', callback_data)
+    return renderers
+
+
+class BKCorner(bkcorner.BKCorner):
+    """
+    The corner plot from bkcorner, opened in a browser in server mode.
+    """
     def __init__(self, df, params=[], logify=False, output='notebook', notebook_url="http://localhost:8888", **kwargs):
-        self.df = df
-        self.params = params
-        self.logify = logify
-        self.kwargs = kwargs
-
-        if output == 'notebook':
-            reset_output()
-            output_notebook()
-            show(self.modify_doc, notebook_url=notebook_url)
-        else:
-            reset_output()
-            server = Server({'/': self.modify_doc})
-            server.start()
-            try:
-                server = Server({'/': self.modify_doc})
-                server.run_until_shutdown()
-            except:
-                pass
-                #print("Server running")
-            server.show("/")
-            self.server = server
-
-    def modify_doc(self, doc):
-        df, params, logify = self.df, self.params, self.logify
-        if params == []:
-            params = df.columns
-
-        kwargs = {
-            "panel_width": 150,
-            "label_all_axes": False,
-        }
-        for key in self.kwargs.keys():
-            kwargs[key] = self.kwargs[key]
-
-        if isinstance(logify,bool):
-            logify = [logify]*len(params)
-        data = {}
-        for i in range(len(params)):
-            if logify[i]:
-                data[params[i]] = np.log10(df[params[i]])
-            else:
-                data[params[i]] = df[params[i]]
-
-        def callback(attr, old, new):
-            indices = source.selected.indices
-            for par in params:
-                old_data = src_hist[par].data
-                edges = np.concatenate([old_data["left"], [old_data["right"][-1]]])
-                hist, edges = np.histogram(data[par][indices], density=False, bins=edges)
-                new_data = {
-                    "top": hist,
-                    "left": edges[:-1],
-                    "right": edges[1:]
-                }   
-
-                src_hist[par].data = new_data
-
-            medians = {par: [np.median(data[par][indices])] for par in params}
-            src_medians.data = medians  
-
-        source = ColumnDataSource(data)
-        src_hist, src_medians = {}, {}
-        for par in params:
-            hist, edges = np.histogram(data[par], density=False, bins=20)
-            hist_df = pd.DataFrame({
-                "top": 0.*hist,
-                "left": edges[:-1],
-                "right": edges[1:]
-            })
-            src_hist[par] = ColumnDataSource(hist_df)
-        medians = {par: [np.median(data[par])] for par in params}
-        src_medians = ColumnDataSource(data = medians)
-
-        TOOLS = 'lasso_select, reset'
-        Nparam = len(params)
-        ax = np.full((Nparam,Nparam), None).tolist()
-        #toggle_botton = Button(label='c')
-        for row in range(Nparam):
-            for col in range(row+1):
-                vline = Span(location=medians[params[col]][0], dimension='height', line_color='black', line_width=1.5, line_dash='dashed')
-                hline = Span(location=medians[params[row]][0], dimension='width', line_color='black', line_width=1.5, line_dash='dashed')
-
-                #vline = Span(location=params[col], source=src_medians, dimension='height', line_color='orange', line_width=1.5, line_dash='dashed')
-                #hline = Span(location=row, dimension='width', line_color='orange', line_width=1.5, line_dash='dashed')
-                if col==0:
-                    width = int(kwargs["panel_width"]*1.25)
-                else:
-                    width = kwargs["panel_width"]
-                if row==Nparam-1:
-                    height = int(kwargs["panel_width"]*1.25)
-                else:
-                    height = kwargs["panel_width"]
-                if row == col:
-                    hist, edges = np.histogram(data[params[col]], density=False, bins=20)
-                    ax[row][col] = figure(width=width, height=height, tools=TOOLS) #, title=params[col])
-                    ax[row][col].quad(top=hist, bottom=0, left=edges[:-1], right=edges[1:],
-                           fill_color="navy", line_color="white", alpha=0.5)
-                    ax[row][col].add_layout(vline)
-
-                    # Histogram of selected points
-                    ax[row][col].quad(
-                        bottom = 0, top = "top",left = "left", right = "right", source = src_hist[params[col]],
-                        fill_color = 'orange', line_color = "white", fill_alpha = 0.5, line_width=0.1)
-                else:
-                    ax[row][col] = figure(width=width, height=height, tools=TOOLS)
-                    ax[row][col].scatter(
-                        params[col],params[row],source=source, size=5,
-                        fill_color='blue',line_color='navy', fill_alpha=0.4, line_alpha=0.4,
-                        nonselection_fill_color='blue', nonselection_line_color='navy',nonselection_alpha=0.4, nonselection_line_alpha=0.4,
-                        selection_fill_color='orange', selection_line_color='orange', selection_alpha=0.5,
-                    )
-                    ax[row][col].add_layout(vline)
-                    ax[row][col].add_layout(hline)
-                if col == 0:
-                    ax[row][col].yaxis.axis_label = params[row]
-                else:
-                    ax[row][col].yaxis.major_label_text_font_size = '0pt'
-                if row == Nparam-1:
-                    ax[row][col].xaxis.axis_label = params[col]
-                else:
-                    ax[row][col].xaxis.major_label_text_font_size = '0pt'
-                if kwargs["label_all_axes"]:
-                    ax[row][col].yaxis.axis_label = params[row]
-                    ax[row][col].xaxis.axis_label = params[col]
-        ax_grid = gridplot(ax)
-
-        source.selected.on_change('indices', callback)
-
-        # add the layout to curdoc
-        doc.add_root(ax_grid)
\ No newline at end of file
+        super().__init__(
+            df, params=params, logify=logify, output='notebook' if output == 'notebook' else None,
+            notebook_url=notebook_url, **kwargs)
+        if output != 'notebook':
+            self.serve()
+            view(self.url)
@@ -0,0 +1,538 @@
+"""
+The broad line region (BLR) particle model of the slider app, split into
+stages with declared parameter dependencies so that a slider change only
+recomputes the stages downstream of that parameter.
+
+The stages broadcast, so buildModels() evaluates a whole ensemble of
+parameter sets (e.g. posterior samples) at once, one model per row.
+"""
+import mmap
+import multiprocessing
+
+import numpy as np
+
+from bkcache import ArrayCache, nbytes
+
+G = 6.673e-11
+
+
+def rotate(x, y, C, S):
+    return C*x + S*y, -S*x + C*y
+
+
+def inverseCDF(xvals, cdf, rand, interpolate=True):
+    """
+    Draws from a tabulated distribution by inverting its cdf with a binary
+    search, O(N log Ngrid) for N draws.
+
+    xvals (array): The grid the cdf is tabulated on
+    cdf (array): The cumulative distribution, non-decreasing
+    rand (array): Uniform random values in [0, 1]
+    interpolate (bool): Interpolate linearly between the grid points. If False,
+        the grid point whose cdf is nearest to rand is returned.
+
+    A 2D cdf holds one distribution per row, and the draws are returned
+    with one row per distribution.
+    """
+    if np.ndim(cdf) == 2:
+        return np.stack([inverseCDF(xvals, row, rand, interpolate) for row in cdf])
+    if interpolate:
+        # Drop the flat ends of the cdf, which hold no probability
+        start = np.searchsorted(cdf, cdf[0], side='right') - 1
+        end = np.searchsorted(cdf, cdf[-1]) + 1
+        return np.interp(rand, cdf[start:end], xvals[start:end])
+    hi = np.minimum(np.searchsorted(cdf, rand), len(cdf)-1)
+    lo = np.maximum(hi - 1, 0)
+    nearest = np.where(np.abs(cdf[lo] - rand) <= np.abs(cdf[hi] - rand), lo, hi)
+    # Like argmin, take the first grid point with that cdf value
+    return xvals[np.searchsorted(cdf, cdf[nearest])]
+
+
+# Each stage is computed from the parameters it depends on, the random draws
+# and the arrays of its input stages, and returns a dict of arrays.
+
+def geometryStage(params, randoms, inputs):
+    # Pre-calculate the sines and cosines of the random angles
+    return {
+        "sinPhi": np.sin(randoms['phi']),
+        "cosPhi": np.cos(randoms['phi']),
+        "sin2": np.sin(randoms['rand3'] * np.pi),
+        "cos2": np.cos(randoms['rand3'] * np.pi),
+    }
+
+
+def radialProfileStage(params, randoms, inputs):
+    beta, mu, F = params['beta'], params['mu'], params['F']
+    alpha = beta**-2.0
+    rmin = mu * F
+    theta = (mu - rmin) / alpha
+
+    # Compute the gamma distribution from 0 to rmax, then normalize
+    rmax = 500.
+    xvals = np.linspace(0,rmax,500)
+    gamma_distr = (xvals - rmin)**(alpha - 1.) * np.exp(-(xvals - rmin) / theta)
+    gamma_distr = np.where(~np.isnan(gamma_distr), gamma_distr, 0.0)
+    gamma_distr = np.where(gamma_distr > 0.0, gamma_distr, 0.0)
+    gamma_distr = gamma_distr / np.sum(gamma_distr, axis=-1, keepdims=True)
+    return {"xvals": xvals, "gamma_distr": gamma_distr, "cdf": np.cumsum(gamma_distr, axis=-1)}
+
+
+def radiiStage(params, randoms, inputs):
+    # Take sorted distribution of values 0-1 to draw from cdf
+    return {"r": inverseCDF(inputs["xvals"], inputs["cdf"], randoms['rand1'])}
+
+
+def openingStage(params, randoms, inputs):
+    # Determine the per-particle opening angles
+    thetao, gamma = params['thetao'], params['gamma']
+    part1 = np.cos(thetao * np.pi / 180.)
+    part2 = 1. - np.cos(thetao * np.pi / 180.)
+    part3 = np.exp(np.log(randoms['rand2']) * gamma)
+    angle = np.arccos(part1 + part2 * part3)
+    return {"sin1": np.sin(angle), "cos1": np.cos(angle)}
+
+
+def diskStage(params, randoms, inputs):
+    r = inputs["r"]
+    # Turn radial distribution into a disk
+    x = r * inputs["cosPhi"]
+    y = r * inputs["sinPhi"]
+    z = np.zeros(np.shape(r))
+    # Puff up by opening angle
+    x, z = rotate(x, z, inputs["cos1"], inputs["sin1"])
+    # Restore axi-symmetry
+    x, y = rotate(x, y, inputs["cos2"], inputs["sin2"])
+    return {"x_disk": x, "y": y, "z_disk": z}
+
+
+def inclinationStage(params, randoms, inputs):
+    thetai = params['thetai']
+    return {
+        "sin3": np.sin(0.5 * np.pi - thetai * np.pi / 180.),
+        "cos3": np.cos(0.5 * np.pi - thetai * np.pi / 180.),
+    }
+
+
+def positionsStage(params, randoms, inputs):
+    # Rotate by inclination angle (+pi/2)
+    x, z = rotate(inputs["x_disk"], inputs["z_disk"], inputs["cos3"], inputs["sin3"])
+    return {"x": x, "z": z}
+
+
+def diskVelocityStage(params, randoms, inputs):
+    r, sinPhi, cosPhi = inputs["r"], inputs["sinPhi"], inputs["cosPhi"]
+    Mbh = 10**params['logMbh']
+
+    # Assume purely circular for now
+    vr = np.zeros(np.shape(r))
+    vphi = np.sqrt(G * Mbh / r)  # * sin(theta)*exp(radial_sd_orbiting*n2[i][j]);
+
+    # Convert to cartesian coordinates
+    vx = vr * cosPhi - vphi * sinPhi
+    vy = vr * sinPhi + vphi * cosPhi
+    vz = np.zeros(np.shape(vx))
+
+    # Puff up by opening angle
+    vx, vz = rotate(vx, vz, inputs["cos1"], inputs["sin1"])
+    # Restore axi-symmetry
+    vx, vy = rotate(vx, vy, inputs["cos2"], inputs["sin2"])
+    return {"vx_disk": vx, "vz_disk": vz}
+
+
+def velocitiesStage(params, randoms, inputs):
+    # Rotate by inclination angle (+pi/2)
+    vx, vz = rotate(inputs["vx_disk"], inputs["vz_disk"], inputs["cos3"], inputs["sin3"])
+    # Convert vx to km/s
+    vx *= 299792458. / 1000.
+    return {"vx": vx}
+
+
+def weightsStage(params, randoms, inputs):
+    r, x = inputs["r"], inputs["x"]
+    size = 0.5 + params['kappa'] * x/r
+    size = np.where(np.isnan(size),0.0,size)
+    size *= 1.0 * size.shape[-1] / np.sum(size, axis=-1, keepdims=True)
+    return {"size": size}
+
+
+def lagsStage(params, randoms, inputs):
+    return {"lags": inputs["r"] - inputs["x"]}
+
+
+# (name, parameters, input stages, function), in an order where every stage
+# comes after its inputs
+STAGES = [
+    ("geometry", (), (), geometryStage),
+    ("radial_profile", ("beta", "mu", "F"), (), radialProfileStage),
+    ("radii", (), ("radial_profile",), radiiStage),
+    ("opening", ("thetao", "gamma"), (), openingStage),
+    ("disk", (), ("geometry", "radii", "opening"), diskStage),
+    ("inclination", ("thetai",), (), inclinationStage),
+    ("positions", (), ("disk", "inclination"), positionsStage),
+    ("disk_velocity", ("logMbh",), ("geometry", "radii", "opening"), diskVelocityStage),
+    ("velocities", (), ("disk_velocity", "inclination"), velocitiesStage),
+    ("weights", ("kappa",), ("radii", "positions"), weightsStage),
+    ("lags", (), ("radii", "positions"), lagsStage),
+]
+
+
+# The model parameters: (name, slider title, start, end, step, default value)
+PARAMETERS = [
+    ("thetai", "Inclination angle (deg)", 0.0, 90., 1, 40.),
+    ("thetao", "Opening angle (deg)", 0.0, 90., 1, 30.),
+    ("gamma", "Gamma", 1.0, 5.0, 0.1, 3.0),
+    ("kappa", "Kappa", -0.5, 0.5, 0.05, -0.4),
+    ("beta", "Beta", 0.1, 2.0, 0.05, 0.85),
+    ("mu", "Mu (light days)", 7.5, 72.5, 1, 19.5),
+    ("F", "F", 0.125, 0.825, 0.01, 0.29),
+    ("logMbh", "log10(Mbh/Msun)", 6.5, 8.5, 0.1, 7.9),
+]
+
+
+# The model arrays each intermediate array ends up in
+OUTPUTS = {
+    "x": "x", "y": "y", "z": "z", "vx": "vx", "lags": "lags", "size": "size", "r": "r",
+    "xvals": "gamma_x", "gamma_distr": "gamma_y",
+}
+
+
+class StagedModel():
+    """
+    The BLR model of one session. The arrays of every stage are kept, and
+    update() only recomputes the stages whose parameters changed and the
+    stages downstream of them.
+    """
+    def __init__(self, randoms, stages=STAGES):
+        """
+        randoms (dict): The random draws rand1, rand2, rand3 and phi
+        stages (list): The (name, parameters, inputs, function) of each stage
+        """
+        self.randoms = randoms
+        self.stages = stages
+        self.outputs = {}
+        self.params = None
+
+    def inputs(self, names):
+        inputs = {}
+        for name in names:
+            inputs.update(self.outputs[name])
+        return inputs
+
+    def dirty(self, old, new):
+        """
+        Returns the names of the stages that differ between the parameter
+        sets old and new (all of them if old is None).
+        """
+        changed_params = set(new.keys())
+        if old is not None:
+            changed_params = {key for key in new.keys() if new[key] != old.get(key)}
+        dirty = []
+        for name, depends, inputs, compute in self.stages:
+            if name not in self.outputs or not changed_params.isdisjoint(depends) or not set(dirty).isdisjoint(inputs):
+                dirty.append(name)
+        return dirty
+
+    def affected(self, old, new):
+        """
+        Returns the names of the model arrays (see arrays()) that differ
+        between the parameter sets old and new, without computing them.
+        """
+        changed = set()
+        for name in self.dirty(old, new):
+            if name not in self.outputs:
+                return set(OUTPUTS.values())
+            changed.update(OUTPUTS[key] for key in self.outputs[name].keys() if key in OUTPUTS)
+        return changed
+
+    def update(self, params):
+        """
+        Recomputes the model for new parameter values.
+
+        Returns the names of the model arrays (see arrays()) that changed.
+        """
+        changed = self.affected(self.params, params)
+        dirty = self.dirty(self.params, params)
+        self.params = dict(params)
+        for name, depends, inputs, compute in self.stages:
+            if name in dirty:
+                self.outputs[name] = compute(self.params, self.randoms, self.inputs(inputs))
+        return changed
+
+    def arrays(self):
+        """
+        Returns the model arrays: x, y, z, vx, lags, size, r, and the radial
+        profile gamma_x, gamma_y.
+        """
+        a = self.inputs([stage[0] for stage in self.stages])
+        return {
+            "x": a["x"], "y": a["y"], "z": a["z"], "vx": a["vx"], "lags": a["lags"], "size": a["size"],
+            "r": a["r"], "gamma_x": a["xvals"], "gamma_y": a["gamma_distr"],
+        }
+
+
+class CachedModel():
+    """
+    A StagedModel with an LRU cache (bounded by bytes) of the model arrays,
+    keyed by the parameters quantized to the slider steps. As the sliders
+    only reach a lattice of values, going back and forth over the same
+    values is a cache hit.
+    """
+    def __init__(self, randoms, steps, max_bytes=256*1024**2):
+        """
+        randoms (dict): The random draws rand1, rand2, rand3 and phi
+        steps (dict): The (start, end, step) of each parameter's slider
+        max_bytes (int): The cache size
+        """
+        self.model = StagedModel(randoms)
+        self.neighbour_model = StagedModel(randoms)
+        self.steps = steps
+        self.cache = ArrayCache(max_bytes=max_bytes)
+
+    def key(self, params):
+        return tuple(
+            (name, int(round((params[name] - self.steps[name][0]) / self.steps[name][2])))
+            for name in sorted(params.keys())
+        )
+
+    def get(self, params, old=None):
+        """
+        Returns the names of the model arrays that differ from those of the
+        parameters old, and all the model arrays for params.
+        """
+        arrays = self.cache.get(self.key(params))
+        if arrays is None:
+            self.model.update(params)
+            arrays = self.cache.put(self.key(params), self.model.arrays())
+        return self.model.affected(old, params), arrays
+
+    def neighbours(self, params):
+        """
+        Returns the parameter sets one slider step away from params.
+        """
+        neighbours = []
+        for name in sorted(params.keys()):
+            start, end, step = self.steps[name]
+            for value in [params[name] - step, params[name] + step]:
+                if start - 1e-9*step <= value <= end + 1e-9*step:
+                    neighbours.append(dict(params, **{name: value}))
+        return neighbours
+
+    def prefetch(self, params):
+        """
+        Computes and caches the model for params unless it is cached. Uses
+        its own StagedModel, so the model of the displayed values is kept.
+        Nothing is evicted to make room for a prefetched model.
+        """
+        key = self.key(params)
+        full = self.cache.total_bytes + nbytes(self.model.arrays()) > self.cache.max_bytes
+        if key not in self.cache and not full:
+            self.neighbour_model.update(params)
+            self.cache.put(key, self.neighbour_model.arrays())
+
+
+def buildModel(randoms, params):
+    """
+    Computes the whole model at once.
+    """
+    model = StagedModel(randoms)
+    model.update(params)
+    a = model.arrays()
+    return a["x"], a["y"], a["z"], a["vx"], a["lags"], a["size"], a["gamma_x"], a["gamma_y"]
+
+
+def buildChunk(randoms, params):
+    # The stacked model arrays of one chunk of an ensemble
+    model = StagedModel(randoms)
+    model.update(params)
+    a = model.arrays()
+    rows = len(next(iter(params.values())))
+    return {key: np.broadcast_to(value, (rows,) + np.shape(value)[-1:]) for key, value in a.items()}
+
+
+# The inputs and outputs of the ensemble being built, inherited by the forked
+# pool workers
+_ensemble = {}
+def buildInto(start, stop):
+    # Builds the models start:stop into the shared output arrays
+    params = {key: value[start:stop, None] for key, value in _ensemble["params"].items()}
+    for key, value in buildChunk(_ensemble["randoms"], params).items():
+        _ensemble["out"][key][start:stop] = value
+
+
+def sharedArray(shape):
+    # An array in anonymous shared memory, written to by forked processes
+    buffer = mmap.mmap(-1, max(1, int(np.prod(shape)) * 8))
+    return np.frombuffer(buffer, dtype=float, count=int(np.prod(shape))).reshape(shape)
+
+
+def buildModels(randoms, params, max_bytes=512*1024**2, processes=None):
+    """
+    Computes the models of an ensemble of parameter sets, broadcasting each
+    stage over the models of a chunk.
+
+    randoms (dict): The random draws rand1, rand2, rand3 and phi, shared by
+        all models
+    params (dict or DataFrame): The parameters, each an array with one value
+        per model (e.g. the rows of a posterior sample) or a scalar
+    max_bytes (int): The memory budget of a chunk of models
+    processes (int): Build the chunks in a pool of this many forked
+        processes, which write into shared memory
+
+    Returns a dict of the model arrays (see StagedModel.arrays()) stacked
+    with one row per model: x, y, z, vx, lags, size and r with one column per
+    particle, gamma_x and gamma_y with one column per radial grid point.
+    """
+    params = {key: np.atleast_1d(np.asarray(params[key], dtype=float)) for key in params.keys()}
+    nmodels = max(len(value) for value in params.values())
+    params = {key: np.broadcast_to(value, (nmodels,)) for key, value in params.items()}
+    # Roughly 16 arrays with one value per particle are held per model while
+    # the stages run
+    nparticles = len(randoms['rand1'])
+    chunk = max(1, int(max_bytes // (16 * 8 * nparticles)))
+    if processes is not None and processes > 1:
+        # At least one chunk per process
+        chunk = min(chunk, -(-nmodels // processes))
+    bounds = [(start, min(start + chunk, nmodels)) for start in range(0, nmodels, chunk)]
+
+    if processes is None or processes < 2 or len(bounds) < 2:
+        results = [
+            buildChunk(randoms, {key: value[start:stop, None] for key, value in params.items()})
+            for start, stop in bounds
+        ]
+        return {key: np.concatenate([r[key] for r in results]) for key in results[0].keys()}
+
+    # Sending the results back through pipes would take longer than building
+    # them, so the workers write into shared arrays instead
+    ngrid = len(radialProfileStage({"beta": 1., "mu": 1., "F": 0.}, randoms, {})["xvals"])
+    _ensemble.update(randoms=randoms, params=params, out={
+        key: sharedArray((nmodels, nparticles)) for key in ["x", "y", "z", "vx", "lags", "size", "r"]
+    })
+    _ensemble["out"].update(gamma_x=sharedArray((nmodels, ngrid)), gamma_y=sharedArray((nmodels, ngrid)))
+    try:
+        with multiprocessing.get_context("fork").Pool(min(processes, len(bounds))) as pool:
+            pool.starmap(buildInto, bounds)
+        return _ensemble["out"]
+    finally:
+        _ensemble.clear()
+
+
+class TransferFunction():
+    """
+    The weighted 2D histogram of the particles in velocity-lag space, i.e.
+    the transfer function, with its velocity profile and lag distribution.
+    The bin of each particle is kept, so a change of the weights alone (e.g.
+    kappa) is a single bincount.
+    """
+    def __init__(self, vx_range=(-15000., 15000.), lag_range=(0., 100.), bins=(150, 100)):
+        """
+        vx_range (tuple): The (start, end) of the velocity axis (km/s)
+        lag_range (tuple): The (start, end) of the lag axis (light days)
+        bins (tuple): The number of velocity and lag bins
+        """
+        self.vx_range = vx_range
+        self.lag_range = lag_range
+        self.bins = bins
+        self.inside = None
+        self.index = None
+
+    def binIndices(self, vx, lags):
+        # The flat (lag-major) bin of each particle inside the ranges
+        nx, ny = self.bins
+        ix = np.floor((vx - self.vx_range[0]) * (nx / (self.vx_range[1] - self.vx_range[0])))
+        iy = np.floor((lags - self.lag_range[0]) * (ny / (self.lag_range[1] - self.lag_range[0])))
+        self.inside = (ix >= 0) & (ix < nx) & (iy >= 0) & (iy < ny)
+        self.index = (iy[self.inside] * nx + ix[self.inside]).astype(np.intp)
+
+    def update(self, changed, arrays):
+        """
+        Returns the transfer function image (lags by velocity, normalized to
+        the fraction of the total weight per bin), the velocity profile and
+        the lag distribution.
+
+        changed (set): The names of the model arrays that changed since the
+            last update; the bins are only recomputed if vx or lags did
+        arrays (dict): The model arrays vx, lags and size
+        """
+        if self.index is None or "vx" in changed or "lags" in changed:
+            self.binIndices(arrays["vx"], arrays["lags"])
+        nx, ny = self.bins
+        weights = arrays["size"][self.inside]
+        image = np.bincount(self.index, weights=weights, minlength=nx*ny).reshape(ny, nx)
+        image /= max(np.sum(arrays["size"]), 1e-300)
+        return image, image.sum(axis=0), image.sum(axis=1)
+
+    def centers(self):
+        """
+        Returns the bin centers of the velocity and lag axes.
+        """
+        vx_edges = np.linspace(self.vx_range[0], self.vx_range[1], self.bins[0] + 1)
+        lag_edges = np.linspace(self.lag_range[0], self.lag_range[1], self.bins[1] + 1)
+        return 0.5*(vx_edges[1:] + vx_edges[:-1]), 0.5*(lag_edges[1:] + lag_edges[:-1])
+
+
+class LightCurvePredictor():
+    """
+    Predicts the emission line light curve of a model by convolving the
+    continuum with the model's lag distribution. The continuum is
+    interpolated onto a regular grid and Fourier transformed once, so each
+    prediction is a histogram of the lags and one pair of FFTs.
+    """
+    def __init__(self, time, flux, dt=None, max_lag=100.):
+        """
+        time, flux (arrays): The continuum light curve (days)
+        dt (float): The grid spacing, the median spacing of the continuum
+            epochs if None
+        max_lag (float): The longest lag of the transfer function (days)
+        """
+        order = np.argsort(time)
+        time, flux = np.asarray(time, dtype=float)[order], np.asarray(flux, dtype=float)[order]
+        self.dt = float(np.median(np.diff(time))) if dt is None else dt
+        self.nlag = int(np.ceil(max_lag / self.dt)) + 1
+        # The grid starts max_lag before the first epoch, where the continuum is
+        # held at its first value
+        self.grid = time[0] - (self.nlag - 1)*self.dt + self.dt*np.arange(
+            int(np.floor((time[-1] - time[0]) / self.dt)) + self.nlag)
+        # Zero padded so the FFT convolution does not wrap around
+        self.nfft = 1 << (len(self.grid) + self.nlag - 2).bit_length()
+        self.cont_fft = np.fft.rfft(np.interp(self.grid, time, flux), self.nfft)
+
+    def kernel(self, lags, weights):
+        """
+        Returns the transfer function projected onto lag: the weights of the
+        particles in each lag bin of the grid, normalized to sum to 1.
+        """
+        index = np.floor(lags / self.dt + 0.5)
+        inside = (index >= 0) & (index < self.nlag)
+        psi = np.bincount(index[inside].astype(np.intp), weights=weights[inside], minlength=self.nlag)
+        total = np.sum(psi)
+        return psi / total if total > 0 else psi
+
+    def predict(self, lags, weights):
+        """
+        Returns the grid times from the first continuum epoch on, and the
+        predicted line light curve at those times (in continuum units).
+
+        lags (array): The lag of each particle (days)
+        weights (array): The weight of each particle, e.g. the model's size
+        """
+        psi = self.kernel(lags, weights)
+        line = np.fft.irfft(self.cont_fft * np.fft.rfft(psi, self.nfft), self.nfft)
+        # Only the times with a full max_lag of continuum before them
+        return self.grid[self.nlag-1:], line[self.nlag-1:len(self.grid)]
+
+
+def scaleToData(t, line, time, flux, flux_err=None):
+    """
+    Scales and offsets a predicted light curve to best fit (least squares)
+    the observed line fluxes.
+
+    t, line (arrays): The predicted light curve
+    time, flux, flux_err (arrays): The observed light curve
+
+    Returns the scaled line.
+    """
+    model = np.interp(time, t, line)
+    w = np.ones(len(flux)) if flux_err is None else 1. / np.maximum(flux_err, 1e-300)
+    design = np.vstack([model, np.ones(len(model))]).T * w[:, None]
+    (scale, offset), *_ = np.linalg.lstsq(design, flux * w, rcond=None)
+    return scale*line + offset
@@ -0,0 +1,118 @@
+"""
+Parsing of the files uploaded to the caramel file viewer. Text files are
+parsed by numpy's C reader straight from the decoded bytes, and .npy/.npz
+files, recognised by their contents, are loaded without parsing.
+
+loadDataset() reads the viewer's default dataset, once per server process
+(see the app's app_hooks.py), through a .npz cache of the parsed arrays.
+"""
+import io
+import os
+import zipfile
+from base64 import b64decode
+
+import numpy as np
+
+NPY_MAGIC = b'\x93NUMPY'
+ZIP_MAGIC = b'PK\x03\x04'
+
+
+def parseText(raw, skiprows=0):
+    """
+    Parses a whitespace separated table of numbers.
+
+    raw (bytes): The file contents
+    skiprows (int): The number of lines to skip at the start
+
+    Returns a 2D array with one row per line.
+    """
+    return np.loadtxt(io.BytesIO(raw), skiprows=skiprows, ndmin=2)
+
+
+def parseUpload(value, name=None, skiprows=0):
+    """
+    Decodes and parses the value of a FileInput.
+
+    value (str): The base64 encoded file
+    name (str): The array to take from a .npz file with several arrays
+    skiprows (int): The number of lines to skip at the start of a text file
+
+    Returns a 2D array. Raises ValueError if the file can't be read.
+    """
+    raw = b64decode(value)
+    try:
+        if raw.startswith(NPY_MAGIC):
+            array = np.load(io.BytesIO(raw), allow_pickle=False)
+        elif raw.startswith(ZIP_MAGIC):
+            with np.load(io.BytesIO(raw), allow_pickle=False) as archive:
+                if len(archive.files) == 1:
+                    name = archive.files[0]
+                elif name not in archive.files:
+                    raise ValueError("The .npz upload has arrays {}, expected '{}'".format(archive.files, name))
+                array = archive[name]
+        else:
+            array = parseText(raw, skiprows)
+    except (OSError, EOFError, zipfile.BadZipFile) as e:
+        # Truncated or corrupt .npy/.npz files, reported like the parse errors
+        raise ValueError(str(e)) from e
+    return np.atleast_2d(np.asarray(array, dtype=float))
+
+
+def sortEpochs(times, spec, err):
+    """
+    Puts the epochs in time order, as the viewer's hover callback's binary
+    search needs.
+    """
+    order = np.argsort(times[:,0], kind='stable')
+    return times[order], spec[order], err[order]
+
+
+DATASET_FILES = ["spectra.txt", "continuum.txt", "times.txt"]
+DATASET_CACHE = "dataset_cache.npz"
+
+
+def parseDataset(directory):
+    # Parses the text files, with the times in HJD - 2450000 (days)
+    spectra = np.loadtxt(os.path.join(directory, "spectra.txt"))
+    cont = np.loadtxt(os.path.join(directory, "continuum.txt"))
+    times = np.loadtxt(os.path.join(directory, "times.txt"))
+    cont[:,0] = cont[:,0] / 86400. - 2450000
+    times[:,0] = times[:,0] / 86400. - 2450000
+    times, spec, err = sortEpochs(times, spectra[1::2], spectra[2::2])
+    return {"wave": spectra[0], "spec": spec, "err": err, "cont": cont, "times": times}
+
+
+def loadDataset(directory, cache=True):
+    """
+    Loads the spectra.txt, continuum.txt and times.txt of directory. The
+    parsed arrays are saved to dataset_cache.npz next to them, which is used
+    instead of the text files until one of those is modified.
+
+    directory (str): The directory of the text files
+    cache (bool): Whether to read and write the .npz cache
+
+    Returns a dict of read-only arrays: wave, spec and err (one row per
+    epoch, in time order), cont and times.
+    """
+    mtimes = np.array([os.path.getmtime(os.path.join(directory, name)) for name in DATASET_FILES])
+    path = os.path.join(directory, DATASET_CACHE)
+    dataset = None
+    if cache and os.path.exists(path):
+        with np.load(path, allow_pickle=False) as archive:
+            if np.array_equal(archive["mtimes"], mtimes):
+                dataset = {name: archive[name] for name in archive.files if name != "mtimes"}
+    if dataset is None:
+        dataset = parseDataset(directory)
+        if cache:
+            # Written to a temporary file first, so other processes never read a
+            # partial cache
+            tmp = "{}.{}.tmp".format(path, os.getpid())
+            try:
+                with open(tmp, 'wb') as f:
+                    np.savez(f, mtimes=mtimes, **dataset)
+                os.replace(tmp, path)
+            except OSError as e:
+                print("Could not write the dataset cache {}: {}".format(path, e))
+    for array in dataset.values():
+        array.flags.writeable = False
+    return dataset
@@ -0,0 +1,54 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'code'))
+from blrmodel import inverseCDF, radialProfileStage
+
+# (beta, mu, F) of the radial profiles, across the slider ranges
+PROFILES = [(0.85, 19.5, 0.29), (0.5, 10., 0.125), (1.0, 20., 0.5), (1.5, 7.5, 0.2), (0.1, 40., 0.825), (2.0, 72.5, 0.3)]
+
+
+def profile(beta, mu, F):
+    return radialProfileStage({'beta': beta, 'mu': mu, 'F': F}, {}, {})
+
+
+def baselineDraw(xvals, cdf, rand):
+    # The per-particle draw inverseCDF() replaced
+    return np.array([xvals[np.argmin(abs(cdf - r))] for r in rand])
+
+
+@pytest.mark.parametrize("beta, mu, F", PROFILES)
+def test_nearest_matches_baseline(beta, mu, F):
+    stage = profile(beta, mu, F)
+    rand = np.random.default_rng(0).random(2000)
+    r = inverseCDF(stage["xvals"], stage["cdf"], rand, interpolate=False)
+    np.testing.assert_array_equal(r, baselineDraw(stage["xvals"], stage["cdf"], rand))
+
+
+@pytest.mark.parametrize("beta, mu, F", PROFILES)
+def test_interpolated_within_one_step(beta, mu, F):
+    stage = profile(beta, mu, F)
+    xvals, cdf = stage["xvals"], stage["cdf"]
+    rand = np.random.default_rng(1).random(2000)
+    r = inverseCDF(xvals, cdf, rand)
+    expected = baselineDraw(xvals, cdf, rand)
+    # The baseline snaps draws into the zero-probability gap below rmin (the
+    # flat start of the cdf), and past the end of the cdf when rand is above
+    # its last value
+    rmin = xvals[np.searchsorted(cdf, cdf[0], side='right') - 1]
+    checked = (expected >= rmin) & (rand <= cdf[-1])
+    assert checked.sum() > len(rand) // 2
+    step = xvals[1] - xvals[0]
+    assert np.all(np.abs(r - expected)[checked] <= step * (1 + 1e-9))
+
+
+def test_rows_are_separate_distributions():
+    stages = [profile(*p) for p in PROFILES]
+    cdf = np.stack([s["cdf"] for s in stages])
+    rand = np.random.default_rng(2).random(500)
+    r = inverseCDF(stages[0]["xvals"], cdf, rand)
+    for i in range(len(stages)):
+        np.testing.assert_array_equal(r[i], inverseCDF(stages[i]["xvals"], stages[i]["cdf"], rand))